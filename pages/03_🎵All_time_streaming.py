@@ -6,7 +6,12 @@ from plotting import (
     get_streaming_barplot,
     get_temporal_distribution,
 )
-from streaming_data import get_streaming_df_remote
+from streaming_data import (
+    dataset_version,
+    get_figure_cache,
+    get_streaming_df_remote,
+    get_streaming_queries,
+)
 
 THEME = None
 
@@ -44,12 +49,20 @@ Select the number of songs to show and a time range.
 
 # df = get_streaming_df()
 df = get_streaming_df_remote()
-# Copy to be able to change the df. The original df is cached.
-streaming_df = df.copy()
+# The cached df is shared by all sessions and passed to the plots as is. Its
+# arrays are read-only and the plots never modify it, so it is not copied.
+# Backend of the aggregations of the plots below, so they do not rescan every
+# play. DuckDB over the store, or pandas on the daily rollup of df.
+version = dataset_version(df)
+queries = get_streaming_queries(df, version)
+# Figures built for this dataset version with the same parameters, by any
+# session, are loaded from the cache instead of being built again
+figures = get_figure_cache()
+inputs = {"df": df, "queries": queries}
 
 # Get the time range of the data
-start_date = streaming_df["endTime"].min()
-end_date = streaming_df["endTime"].max()
+start_date = df["endTime"].min()
+end_date = df["endTime"].max()
 
 col1, col2, col3, _, _ = st.columns(5)
 range = col1.slider(
@@ -70,8 +83,12 @@ time_range2 = col3.slider(
     format="DD/MM/YY",
 )
 
-stream_plotly = get_streaming_barplot(
-    df=streaming_df, range=range, time_range=(time_range1, time_range2)
+stream_plotly = figures.figure(
+    version,
+    get_streaming_barplot,
+    inputs,
+    range=range,
+    time_range=(time_range1, time_range2),
 )
 st.plotly_chart(stream_plotly, use_container_width=True, theme=None)
 
@@ -108,8 +125,12 @@ season = st.selectbox(
     "What season to filter on?", ("Winter", "Summer", "Spring", "Autumn", None)
 )
 
-temporal_plotly = get_temporal_distribution(
-    df=streaming_df, time_range=(time_range3, time_range4), season=season
+temporal_plotly = figures.figure(
+    version,
+    get_temporal_distribution,
+    inputs,
+    time_range=(time_range3, time_range4),
+    season=season,
 )
 
 st.plotly_chart(temporal_plotly, use_container_width=True, theme=None)
@@ -123,7 +144,11 @@ I am questioning how useful this visualization is, but I made it so here it is.
 """
 )
 
-plotly_most_played_animated = get_most_played_animation(streaming_df=streaming_df)
+plotly_most_played_animated = figures.figure(
+    version,
+    get_most_played_animation,
+    {"streaming_df": df, "queries": queries},
+)
 st.plotly_chart(plotly_most_played_animated, use_container_width=True, theme=None)
 
 
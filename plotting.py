@@ -3,6 +3,8 @@ import plotly.figure_factory as ff
 from plotly import express as px
 from plotly.subplots import make_subplots
 
+from util.query import PandasQueries
+
 
 # domain=None, title=None
 def get_altair_histogram(data=None, genre_artists_count=None, **plt_kwargs):
@@ -147,10 +149,24 @@ def get_audiofeature_distribution(df, **plt_kwargs):
     return fig
 
 
-def get_temporal_distribution(df, time_range=None, season=None, **plt_kwargs):
+def get_temporal_distribution(
+    df, time_range=None, season=None, rollup=None, queries=None, **plt_kwargs
+):
+    """Top 5 tracks of each weekday in a range of days.
+
+    Args:
+        df (DataFrame): Streaming history. Only read, never modified.
+        time_range (tuple of datetime): First and last day to include.
+        season (str): Only include the months of this season, eg. "Winter".
+        rollup (DailyRollup): Daily rollup of df. Computed from df if None.
+        queries (PandasQueries or DuckDBQueries): Backend of the query. The
+            pandas queries of df and rollup if None.
 
-    # Restrict song name length by skipping possible feature statements in parenthesis
-    df["trackName"] = df["trackName"].str.split("(", expand=True)[0]
+    Returns:
+        fig (plotly figure): Bar plot of each weekday.
+    """
+    if queries is None:
+        queries = PandasQueries(df, rollup)
 
     fig = make_subplots(
         rows=3,
@@ -170,9 +186,6 @@ def get_temporal_distribution(df, time_range=None, season=None, **plt_kwargs):
     row = 0
     col = 0
 
-    mask = (df["endTime"] > time_range[0]) & (df["endTime"] <= time_range[1])
-    df = df.loc[mask]
-
     seasons = {
         "Winter": (12, 1, 2),
         "Summer": (6, 7, 8),
@@ -180,9 +193,10 @@ def get_temporal_distribution(df, time_range=None, season=None, **plt_kwargs):
         "Autumn": (9, 10, 11),
     }
 
-    # Limit to chosen seaon
-    if season:
-        df = getMonths(df, *seasons[season])
+    # Top tracks of every weekday, limited to the chosen season
+    tops = queries.weekday_top_tracks(
+        5, *time_range, months=seasons[season] if season else None
+    )
 
     for i in range(7):
 
@@ -190,12 +204,10 @@ def get_temporal_distribution(df, time_range=None, season=None, **plt_kwargs):
             row += 1
         col = col % 3 + 1
 
-        day = df[df["endTime"].dt.dayofweek == i]
-        count = day.groupby(["trackName", "artistName"], as_index=False).size()
-        sorted_count = count.sort_values(by="size", ascending=False)
+        top = tops[tops["weekday"] == i]
 
         temp_fig = px.bar(
-            sorted_count[0:5],
+            top,
             x="trackName",
             y="size",
             hover_data=["trackName", "artistName"],
@@ -221,26 +233,30 @@ def get_temporal_distribution(df, time_range=None, season=None, **plt_kwargs):
     return fig
 
 
-def getMonths(input, m1, m2, m3):
-    return input.loc[
-        (input.endTime.dt.month == m1)
-        | (input.endTime.dt.month == m2)
-        | (input.endTime.dt.month == m3)
-    ]
-
+def get_streaming_barplot(
+    df=None, range=10, time_range=None, rollup=None, queries=None
+):
+    """Most played tracks in a range of days.
 
-def get_streaming_barplot(df=None, range=10, time_range=None):
-
-    mask = (df["endTime"] > time_range[0]) & (df["endTime"] <= time_range[1])
+    Args:
+        df (DataFrame): Streaming history. Only read, never modified.
+        range (int): Number of tracks to show.
+        time_range (tuple of datetime): First and last day to include.
+        rollup (DailyRollup): Daily rollup of df. Computed from df if None.
+        queries (PandasQueries or DuckDBQueries): Backend of the query. The
+            pandas queries of df and rollup if None.
 
-    df["trackName"] = df["trackName"].str.split("(", expand=True)[0]
-    new_df = df.loc[mask]
+    Returns:
+        fig (plotly figure): Bar plot of the plays of the top tracks.
+    """
+    if queries is None:
+        queries = PandasQueries(df, rollup)
 
-    count = new_df.groupby(["trackName", "artistName"], as_index=False).size()
-    sorted_count = count.sort_values(by="size", ascending=False)
+    # Plays per track title without feature statements in parenthesis
+    top = queries.top_tracks(range, *time_range)
 
     fig = px.bar(
-        sorted_count[0:range],
+        top,
         x="trackName",
         y="size",
         hover_data=["trackName", "artistName"],
@@ -262,19 +278,21 @@ def get_streaming_barplot(df=None, range=10, time_range=None):
     return fig
 
 
-def get_most_played_animation(streaming_df=None):
+def get_most_played_animation(streaming_df=None, queries=None):
+    """Plays and time played of the 100 most played tracks of each year.
 
-    df = (
-        streaming_df.groupby([streaming_df.endTime.dt.year, "trackName", "artistName"])
-        .agg({"ms_played": "sum", "trackName": "count"})
-        .rename(columns={"trackName": "count"})
-        .reset_index()
-    )
-    df = (
-        df.groupby(["endTime"])
-        .apply(lambda x: x.nlargest(100, ["count"]))
-        .reset_index(drop=True)
-    )
+    Args:
+        streaming_df (DataFrame): Streaming history. Only read, never modified.
+        queries (PandasQueries or DuckDBQueries): Backend of the query. The
+            pandas queries of streaming_df if None.
+
+    Returns:
+        fig (plotly figure): Scatter plot animated over the years.
+    """
+    if queries is None:
+        queries = PandasQueries(streaming_df)
+
+    df = queries.yearly_top_tracks(100)
 
     fig = px.scatter(
         df,
@@ -1,206 +1,1017 @@
 """Module responsible for handling spotify interaction."""
-import numpy as np
+import argparse
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, count, islice
+from pathlib import Path
+
 import pandas as pd
+import requests
 import spotipy
 
-# Not sure how this import will affect the app
-import streamlit as st
-from spotipy.oauth2 import SpotifyOAuth
+from util.cache import (
+    ARTIST_GENRES_NS,
+    AUDIO_FEATURES_NS,
+    SpotifyCache,
+    seed_from_playlists,
+)
+from util.client import get_spotify_client
+from util.journal import PlaylistJournal
+from util.metrics import METRICS
+from util.ratelimit import TokenBucket, call
+
+# Maximum number of ids the batch endpoints accept per request
+AUDIO_FEATURES_BATCH_SIZE = 100
+ARTISTS_BATCH_SIZE = 50
+PLAYLIST_PAGE_SIZE = 100
+
+# Number of playlist pages fetched at the same time
+MAX_WORKERS = 8
+
+# Time ranges of the user top tracks, and the maximum page size of the endpoint
+TIME_RANGES = ["short_term", "medium_term", "long_term"]
+TOP_TRACKS_PAGE_SIZE = 50
+
+# Columns of the playlist dataframe. Audio features are the columns from danceability and onwards.
+PLAYLIST_FEATURES = [
+    "artist",
+    "genre",
+    "album",
+    "track_name",
+    "track_id",
+    "danceability",
+    "energy",
+    "key",
+    "loudness",
+    "mode",
+    "speechiness",
+    "instrumentalness",
+    "liveness",
+    "valence",
+    "tempo",
+    "duration_ms",
+    "time_signature",
+]
+AUDIO_FEATURES = PLAYLIST_FEATURES[5:]
+
+# All columns stored for a playlist
+PLAYLIST_COLUMNS = PLAYLIST_FEATURES + ["track_popularity", "added_at", "artist_id"]
+
+# Columns stored for the user top tracks
+TOP_TRACKS_COLUMNS = ["artist", "track_name", "popularity", "explicit"]
+
+# Item fields needed by _get_track_metadata. Used to keep listing a playlist cheap.
+PLAYLIST_ITEM_FIELDS = (
+    "items(added_at,track(id,name,popularity,album(name),artists(id,name)))"
+)
+
+
+def _batches(items, size):
+    """Split list of items into consecutive lists of at most size items."""
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+def get_audio_features(track_ids, sp, cache=None, bucket=None):
+    """Get audio features for a list of tracks using the batch endpoint.
 
+    Args:
+        track_ids (list of str): Track ids to get audio features for.
+        sp (Spotify authentification instance): API authentification handler.
+        cache (SpotifyCache): Optional on-disk cache checked before calling the API.
+        bucket (TokenBucket): Optional rate limiter shared by all API calls.
 
-# Inspiration taken from this:
-# https://www.linkedin.com/pulse/extracting-your-fav-playlist-info-spotifys-api-samantha-jones/
-def analyze_playlist(playlist_id, sp):
-    """Get playlist data from given id and authentification manager.
+    Returns:
+        audio_features (dict): Audio features for each track id. None if not available.
+    """
+    track_ids = list(dict.fromkeys(t for t in track_ids if t is not None))
+    audio_features = (
+        {} if cache is None else cache.get_many(AUDIO_FEATURES_NS, track_ids)
+    )
+    missing = [t for t in track_ids if t not in audio_features]
+
+    fetched = {}
+    for batch in _batches(missing, AUDIO_FEATURES_BATCH_SIZE):
+        try:
+            features = call(sp.audio_features, batch, bucket=bucket)
+        except spotipy.SpotifyException as exception:
+            print(exception)
+            print(f"Error getting audio features for batch of {len(batch)} tracks")
+            audio_features.update(dict.fromkeys(batch))
+            continue
+        fetched.update(zip(batch, features))
+
+    if cache is not None:
+        cache.set_many(AUDIO_FEATURES_NS, fetched)
+    audio_features.update(fetched)
+    return audio_features
+
+
+def get_artist_genres(artist_ids, sp, cache=None, bucket=None):
+    """Get genres for a list of artists using the batch endpoint.
 
     Args:
-        playlist_id (str): ID of playlist to get data for.
+        artist_ids (list of str): Artist ids to get genres for.
         sp (Spotify authentification instance): API authentification handler.
+        cache (SpotifyCache): Optional on-disk cache checked before calling the API.
+        bucket (TokenBucket): Optional rate limiter shared by all API calls.
 
     Returns:
-        playlist (DataFrame): Obtained playlist data.
-        playlist_name (str): Name of playlist with the specified ID.
+        artist_genres (dict): List of genres for each artist id.
     """
+    artist_ids = list(dict.fromkeys(a for a in artist_ids if a is not None))
+    artist_genres = (
+        {} if cache is None else cache.get_many(ARTIST_GENRES_NS, artist_ids)
+    )
+    missing = [a for a in artist_ids if a not in artist_genres]
+
+    fetched = {}
+    for batch in _batches(missing, ARTISTS_BATCH_SIZE):
+        try:
+            artists = call(sp.artists, batch, bucket=bucket)["artists"]
+        except spotipy.SpotifyException as exception:
+            print(exception)
+            print(f"Experienced an error when getting batch of {len(batch)} artists")
+            artist_genres.update((artist_id, []) for artist_id in batch)
+            continue
+        for artist_id, artist in zip(batch, artists):
+            fetched[artist_id] = artist["genres"] if artist else []
+
+    if cache is not None:
+        cache.set_many(ARTIST_GENRES_NS, fetched)
+    artist_genres.update(fetched)
+    return artist_genres
+
+
+def _get_track_metadata(track):
+    """Extract the metadata stored for a playlist item."""
+    return {
+        "artist": track["track"]["artists"][0]["name"],
+        "artist_id": track["track"]["artists"][0]["id"],
+        "album": track["track"]["album"]["name"],
+        "track_name": track["track"]["name"],
+        "track_id": track["track"]["id"],
+        "track_popularity": track["track"]["popularity"],
+        "added_at": track["added_at"],
+    }
+
+
+def _enrich_tracks(tracks, sp, artist_genres, cache=None, bucket=None):
+    """Add audio features and genres to a page of track metadata.
 
-    # Create empty dataframe with relevant columns
-    playlist_features_list = [
-        "artist",
-        "genre",
-        "album",
-        "track_name",
-        "track_id",
-        "danceability",
-        "energy",
-        "key",
-        "loudness",
-        "mode",
-        "speechiness",
-        "instrumentalness",
-        "liveness",
-        "valence",
-        "tempo",
-        "duration_ms",
-        "time_signature",
+    Args:
+        tracks (list of dict): Track metadata as returned by _get_track_metadata.
+        sp (Spotify authentification instance): API authentification handler.
+        artist_genres (dict): Genres of artists already resolved in this run.
+            Artists not in the dict are looked up and added to it.
+        cache (SpotifyCache): Optional on-disk cache checked before calling the API.
+        bucket (TokenBucket): Optional rate limiter shared by all API calls.
+
+    Returns:
+        tracks (list of dict): The tracks with audio feature and genre keys added.
+    """
+    audio_features = get_audio_features(
+        [t["track_id"] for t in tracks], sp, cache, bucket
+    )
+
+    new_artists = [
+        t["artist_id"] for t in tracks if t["artist_id"] not in artist_genres
     ]
-    playlist_df = pd.DataFrame(columns=playlist_features_list)
+    artist_genres.update(get_artist_genres(new_artists, sp, cache, bucket))
+
+    for track in tracks:
+        features = audio_features.get(track["track_id"])
+        for feature in AUDIO_FEATURES:
+            track[feature] = 0 if features is None else features[feature]
+
+        # Convert list of genres to string for storage in dataframe
+        genres = artist_genres.get(track["artist_id"]) or ["unknown"]
+        track["genre"] = "/".join(genres)
+    return tracks
+
+
+def iter_playlist_pages(
+    playlist_id,
+    playlist_length,
+    sp,
+    bucket=None,
+    max_workers=MAX_WORKERS,
+    fields=None,
+    offsets=None,
+):
+    """Fetch the pages of playlist items concurrently and yield them in order.
+
+    At most max_workers pages are requested at the same time, and at most twice
+    that number are held in memory waiting to be consumed.
+
+    Args:
+        playlist_id (str): ID of playlist to get items for.
+        playlist_length (int): Number of tracks in the playlist.
+        sp (Spotify authentification instance): API authentification handler.
+        bucket (TokenBucket): Rate limiter shared by the workers.
+        max_workers (int): Maximum number of pages requested at the same time.
+        fields (str): Optional filter of the item fields returned by the API.
+        offsets (list of int): Offsets of the pages to fetch. Defaults to all pages.
+
+    Yields:
+        page (list of dict): Playlist items of a page, in playlist order.
+    """
+    if offsets is None:
+        offsets = range(0, playlist_length, PLAYLIST_PAGE_SIZE)
+    offsets = iter(offsets)
+
+    def _fetch(offset):
+        page = call(
+            sp.playlist_items,
+            playlist_id=playlist_id,
+            limit=PLAYLIST_PAGE_SIZE,
+            offset=offset,
+            fields=fields,
+            bucket=bucket,
+        )
+        print(f"Processed offset {offset}, total tracks:{playlist_length}")
+        return page["items"]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque(
+            executor.submit(_fetch, offset)
+            for offset in islice(offsets, 2 * max_workers)
+        )
+        while pending:
+            page = pending.popleft().result()
+            for offset in islice(offsets, 1):
+                pending.append(executor.submit(_fetch, offset))
+            yield page
+
+
+def fetch_playlist_pages(
+    playlist_id, playlist_length, sp, bucket=None, max_workers=MAX_WORKERS
+):
+    """Fetch all pages of playlist items concurrently.
+
+    Returns:
+        pages (list of list of dict): Playlist items of each page, in playlist order.
+    """
+    return list(
+        iter_playlist_pages(playlist_id, playlist_length, sp, bucket, max_workers)
+    )
 
-    # Get the number of tracks in the playlist
-    playlist_length = sp.playlist(playlist_id)["tracks"]["total"]
-    playlist_name = sp.playlist(playlist_id)["name"]
 
-    # Create loop values based on playlist length
-    offsets = np.arange(0, playlist_length + (100 - playlist_length % 100), 100)
+def iter_playlist_tracks(
+    playlist_id, sp, cache=None, bucket=None, playlist_length=None, journal=None
+):
+    """Yield the tracks of a playlist with audio features and genres.
+
+    Tracks are enriched one page of 100 at a time with the batch endpoints, so a
+    page costs one audio features call and at most two artist calls. Lookups
+    already in the cache are not requested again.
+
+    Args:
+        playlist_id (str): ID of playlist to get data for.
+        sp (Spotify authentification instance): API authentification handler.
+        cache (SpotifyCache): Optional on-disk cache of artist genres and audio features.
+        bucket (TokenBucket): Rate limiter shared by all API calls. A new one is
+            created if not given.
+        playlist_length (int): Number of tracks in the playlist. Looked up if not given.
+        journal (PlaylistJournal): Optional checkpoint journal. Pages completed by an
+            earlier run are read from it instead of the API, and every newly
+            completed page is recorded in it.
+
+    Yields:
+        track (dict): Record with a value for each of PLAYLIST_COLUMNS.
+    """
+    if bucket is None:
+        bucket = TokenBucket()
+    if playlist_length is None:
+        playlist = call(sp.playlist, playlist_id, fields="tracks.total", bucket=bucket)
+        playlist_length = playlist["tracks"]["total"]
+
+    # Genres of the artists seen so far. Artists are only looked up once per run.
+    artist_genres = {}
+
+    # Only fetch the pages not completed by an earlier run
+    completed = journal.completed() if journal is not None else {}
+    for track in chain.from_iterable(completed.values()):
+        genres = track["genre"].split("/")
+        artist_genres[track["artist_id"]] = [] if genres == ["unknown"] else genres
+    offsets = range(0, playlist_length, PLAYLIST_PAGE_SIZE)
+    pages = iter_playlist_pages(
+        playlist_id,
+        playlist_length,
+        sp,
+        bucket,
+        offsets=[offset for offset in offsets if offset not in completed],
+    )
 
-    # Loop through every track in the playlist,
-    # extract features and append the features to the playlist.
     for offset in offsets:
-        playlist = sp.playlist_items(playlist_id=playlist_id, limit=100, offset=offset)[
-            "items"
-        ]
-        for i, track in enumerate(playlist):
-            if i % 100 == 0:
-                print(f"Processed offset {offset}, total tracks:{playlist_length}")
-            # Create empty dict for holding extracted features
-            playlist_features = {}
+        if offset in completed:
+            yield from completed[offset]
+            continue
 
-            # Get metadata
+        # Get metadata
+        tracks = []
+        for track in next(pages):
             try:
-                playlist_features["artist"] = track["track"]["artists"][0]["name"]
-                playlist_features["album"] = track["track"]["album"]["name"]
-                playlist_features["track_name"] = track["track"]["name"]
-                playlist_features["track_id"] = track["track"]["id"]
-                playlist_features["track_popularity"] = track["track"]["popularity"]
-                playlist_features["added_at"] = track["added_at"]
+                tracks.append(_get_track_metadata(track))
             except Exception as e:
                 print(e)
                 continue
 
-            # Get audio features
-            try:
-                audio_features = sp.audio_features(playlist_features["track_id"])[0]
-            except:
-                print(
-                    f'Error getting audio features for track: {playlist_features["track_name"]},\n'
-                    f"likely not valid track_id"
-                )
-            for feature in playlist_features_list[5:]:
-                if audio_features is None:
-                    playlist_features[feature] = 0
-                else:
-                    playlist_features[feature] = audio_features[feature]
-
-            # Get artist genre
-            this_artist_id = track["track"]["artists"][0]["id"]
-            if this_artist_id is None:
-                this_genres = ["unknown"]
+        # Get audio features and artist genres for the whole page
+        tracks = _enrich_tracks(tracks, sp, artist_genres, cache, bucket)
+        if journal is not None:
+            journal.record(offset, tracks)
+        yield from tracks
+
+
+def _build_frame(records, columns, length=None):
+    """Build a DataFrame from records through one list per column.
+
+    Args:
+        records (iterable of dict): Rows with a value for each column.
+        columns (list of str): Columns of the DataFrame.
+        length (int): Expected number of records, used to preallocate the lists.
+
+    Returns:
+        df (DataFrame): DataFrame with the records as rows.
+    """
+    data = {column: [None] * (length or 0) for column in columns}
+    n_rows = 0
+    for n_rows, record in enumerate(records, start=1):
+        for column in columns:
+            values = data[column]
+            if n_rows > len(values):
+                values.append(record.get(column))
             else:
-                try:
-                    this_artist_info = sp.artist(this_artist_id)
-                    this_genres = this_artist_info["genres"]
-                except spotipy.SpotifyException as exception:
-                    print(exception)
-                    print(
-                        f"Experienced an error when getting artist. Likely invalid artist id for the track: {track['track']['name']}"
-                        f"The artist was : {track['track']['artists'][0]['name']}"
-                    )
-                    this_genres = []
-                if not this_genres:
-                    this_genres = ["unknown"]
-            # Convert list of genres to string for storage in dataframe
-            playlist_features["genre"] = "/".join(this_genres)
-
-            # Concat the dfs
-            track_df = pd.DataFrame(playlist_features, index=[0])
-            playlist_df = pd.concat([playlist_df, track_df], ignore_index=True)
+                values[n_rows - 1] = record.get(column)
+
+    # Drop the preallocated rows that were not used, eg. for skipped tracks
+    data = {column: values[:n_rows] for column, values in data.items()}
+    return pd.DataFrame(data, columns=columns)
+
+
+# Inspiration taken from this:
+# https://www.linkedin.com/pulse/extracting-your-fav-playlist-info-spotifys-api-samantha-jones/
+def analyze_playlist(playlist_id, sp, cache=None, bucket=None, resume=False):
+    """Get playlist data from given id and authentification manager.
 
+    The pages of the playlist are fetched concurrently and enriched with the batch
+    endpoints by iter_playlist_tracks. The DataFrame is built once at the end.
+
+    Args:
+        playlist_id (str): ID of playlist to get data for.
+        sp (Spotify authentification instance): API authentification handler.
+        cache (SpotifyCache): Optional on-disk cache of artist genres and audio features.
+        bucket (TokenBucket): Rate limiter shared by all API calls. A new one is
+            created if not given.
+        resume (bool): Checkpoint completed pages to a journal, and resume from the
+            journal of an earlier interrupted run.
+
+    Returns:
+        playlist (DataFrame): Obtained playlist data.
+        playlist_name (str): Name of playlist with the specified ID.
+    """
+    if bucket is None:
+        bucket = TokenBucket()
+
+    # Get the number of tracks and name of the playlist
+    playlist = call(
+        sp.playlist,
+        playlist_id,
+        fields="name,snapshot_id,tracks.total",
+        bucket=bucket,
+    )
+    playlist_length = playlist["tracks"]["total"]
+    playlist_name = playlist["name"]
+
+    journal = None
+    if resume:
+        journal = PlaylistJournal(playlist_id, playlist.get("snapshot_id"))
+
+    tracks = iter_playlist_tracks(
+        playlist_id, sp, cache, bucket, playlist_length=playlist_length, journal=journal
+    )
+    playlist_df = _build_frame(tracks, PLAYLIST_COLUMNS, length=playlist_length)
+
+    if journal is not None:
+        journal.remove()
     return playlist_df, playlist_name
 
 
-def usage_analysis(sp, period="long_term"):
-    """Get user top tracks and artists.
+def write_playlist(
+    playlist_id,
+    sp,
+    path=None,
+    chunk_size=1000,
+    cache=None,
+    bucket=None,
+    resume=False,
+    playlist=None,
+):
+    """Download a playlist and write it to disk in chunks.
+
+    Only chunk_size tracks are held in memory at a time, so memory use does not
+    grow with the size of the playlist. The format is given by the file suffix,
+    either .csv or .parquet. Parquet requires pyarrow.
 
     Args:
-        sp: spotipy api handler.
+        playlist_id (str): ID of playlist to get data for.
+        sp (Spotify authentification instance): API authentification handler.
+        path (str or Path): File to write. Defaults to data/playlists/{playlist_name}.csv.
+        chunk_size (int): Number of tracks written at a time.
+        cache (SpotifyCache): Optional on-disk cache of artist genres and audio features.
+        bucket (TokenBucket): Rate limiter shared by all API calls.
+        resume (bool): Checkpoint completed pages to a journal, and resume from the
+            journal of an earlier interrupted run.
+        playlist (dict): Name, snapshot_id and tracks.total of the playlist, as
+            returned by sp.playlist. Requested from the API if None.
 
     Returns:
-        top_tracks_df (DataFrame):
+        path (Path): The written file.
+        n_tracks (int): Number of tracks written.
     """
+    if bucket is None:
+        bucket = TokenBucket()
+
+    if playlist is None:
+        playlist = call(
+            sp.playlist,
+            playlist_id,
+            fields="name,snapshot_id,tracks.total",
+            bucket=bucket,
+        )
+    playlist_length = playlist["tracks"]["total"]
+    path = Path(path or f"data/playlists/{playlist['name']}.csv")
+
+    # The file is rewritten from the start when resuming, but pages in the
+    # journal are not requested again.
+    journal = None
+    if resume:
+        journal = PlaylistJournal(playlist_id, playlist.get("snapshot_id"))
+
+    tracks = iter_playlist_tracks(
+        playlist_id, sp, cache, bucket, playlist_length=playlist_length, journal=journal
+    )
+
+    if path.suffix == ".parquet":
+        # Optional dependency, only needed for parquet output
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+    writer = None
+    n_tracks = 0
+    try:
+        for chunk_number in count():
+            chunk = _build_frame(islice(tracks, chunk_size), PLAYLIST_COLUMNS)
+            # The first chunk is always written, so an empty playlist gets a header
+            if chunk.empty and chunk_number > 0:
+                break
+            if path.suffix == ".parquet":
+                table = pa.Table.from_pandas(
+                    chunk,
+                    schema=writer.schema if writer else None,
+                    preserve_index=False,
+                )
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+            else:
+                chunk.to_csv(
+                    path,
+                    mode="a" if chunk_number else "w",
+                    header=chunk_number == 0,
+                    index=False,
+                )
+            n_tracks += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+        if journal is not None:
+            journal.close()
+
+    if journal is not None:
+        journal.remove()
+    return path, n_tracks
+
+
+def _read_playlist_file(path):
+    if path.suffix == ".parquet":
+        return pd.read_parquet(path)
+    return pd.read_csv(path)
+
+
+def _write_playlist_meta(path, playlist_id, snapshot_id, df):
+    """Store snapshot id and latest added_at of a downloaded playlist next to
+    the data file."""
+    meta = {
+        "playlist_id": playlist_id,
+        "snapshot_id": snapshot_id,
+        "added_at": df["added_at"].max() if len(df) else None,
+        "n_tracks": len(df),
+    }
+    path.with_suffix(".json").write_text(json.dumps(meta, indent=2))
+    return meta
+
+
+def refresh_playlist(playlist_id, sp, path=None, cache=None, bucket=None, resume=False):
+    """Update a downloaded playlist with only the tracks that changed.
+
+    The snapshot id of the playlist is stored in a json file next to the data.
+    If the snapshot is unchanged nothing is downloaded. Otherwise the playlist is
+    listed with only the metadata fields, new tracks are enriched with audio
+    features and genres, and removed tracks are dropped. Tracks that were already
+    downloaded keep their stored audio features and genres. If the playlist has not
+    been downloaded before, it is downloaded in full.
+
+    Args:
+        playlist_id (str): ID of playlist to refresh.
+        sp (Spotify authentification instance): API authentification handler.
+        path (str or Path): Data file of the playlist. Defaults to
+            data/playlists/{playlist_name}.csv.
+        cache (SpotifyCache): Optional on-disk cache of artist genres and audio features.
+        bucket (TokenBucket): Rate limiter shared by all API calls.
+        resume (bool): Checkpoint a full download to a journal and resume it if
+            it was interrupted, see write_playlist.
 
-    # Create empty dataframe with relevant columns
-    top_tracks_features_list = [
-        "artist",
-        "track_name",
-        "popularity",
-        "explicit",
+    Returns:
+        path (Path): The data file of the playlist.
+        changes (dict): Number of added and removed tracks. None if unchanged.
+    """
+    if bucket is None:
+        bucket = TokenBucket()
+
+    playlist = call(
+        sp.playlist,
+        playlist_id,
+        fields="name,snapshot_id,tracks.total",
+        bucket=bucket,
+    )
+    playlist_length = playlist["tracks"]["total"]
+    path = Path(path or f"data/playlists/{playlist['name']}.csv")
+    meta_path = path.with_suffix(".json")
+
+    if not path.is_file() or not meta_path.is_file():
+        # Nothing to refresh from, download everything
+        path, n_tracks = write_playlist(
+            playlist_id,
+            sp,
+            path,
+            cache=cache,
+            bucket=bucket,
+            resume=resume,
+            playlist=playlist,
+        )
+        _write_playlist_meta(
+            path, playlist_id, playlist.get("snapshot_id"), _read_playlist_file(path)
+        )
+        return path, {"added": n_tracks, "removed": 0}
+
+    meta = json.loads(meta_path.read_text())
+    if meta["snapshot_id"] == playlist.get("snapshot_id"):
+        print(f"Playlist {playlist['name']} is unchanged since last download")
+        return path, None
+
+    existing_df = _read_playlist_file(path)
+    enriched_columns = ["genre", *AUDIO_FEATURES]
+    stored = existing_df.drop_duplicates("track_id").set_index("track_id")[
+        enriched_columns
     ]
-    top_tracks_df = pd.DataFrame(columns=top_tracks_features_list)
 
-    top_tracks = sp.current_user_top_tracks(time_range="short_term", limit=50)
-    total_top_tracks = top_tracks["total"]
+    # List the current tracks with metadata only
+    tracks = []
+    pages = iter_playlist_pages(
+        playlist_id, playlist_length, sp, bucket, fields=PLAYLIST_ITEM_FIELDS
+    )
+    for page in pages:
+        for track in page:
+            try:
+                tracks.append(_get_track_metadata(track))
+            except Exception as e:
+                print(e)
+                continue
+
+    # Enrich only the tracks that are not already stored
+    new_tracks = [t for t in tracks if t["track_id"] not in stored.index]
+    artist_genres = {}
+    if "artist_id" in existing_df.columns:
+        # Genres of artists already in the playlist are known as well
+        artists = existing_df.dropna(subset=["artist_id"])
+        artist_genres = {
+            artist_id: [] if genre == "unknown" else genre.split("/")
+            for artist_id, genre in zip(artists["artist_id"], artists["genre"])
+        }
+    for batch in _batches(new_tracks, PLAYLIST_PAGE_SIZE):
+        _enrich_tracks(batch, sp, artist_genres, cache, bucket)
+    stored = stored.to_dict("index")
+    for track in tracks:
+        if track["track_id"] in stored:
+            track.update(stored[track["track_id"]])
+
+    playlist_df = _build_frame(tracks, PLAYLIST_COLUMNS, length=len(tracks))
+    if path.suffix == ".parquet":
+        playlist_df.to_parquet(path, index=False)
+    else:
+        playlist_df.to_csv(path, index=False)
+    _write_playlist_meta(path, playlist_id, playlist.get("snapshot_id"), playlist_df)
+
+    current_ids = {t["track_id"] for t in tracks}
+    changes = {
+        "added": len(new_tracks),
+        "removed": int((~existing_df["track_id"].isin(current_ids)).sum()),
+    }
+    print(f"Refreshed playlist {playlist['name']}: {changes}")
+    return path, changes
+
+
+def usage_analysis(sp, period="long_term", bucket=None):
+    """Get user top tracks for a time range.
 
-    # Create loop values based on number of top tracks
-    offsets = np.arange(0, total_top_tracks + (20 - total_top_tracks % 100), 20)
+    Args:
+        sp: spotipy api handler.
+        period (str): Time range of the top tracks. Long term is years of data,
+            medium the last 6 months and short_term the last month.
+        bucket (TokenBucket): Optional rate limiter shared by all API calls.
 
-    for offset in offsets:
-        top_tracks = sp.current_user_top_tracks(
-            limit=50, offset=offset, time_range=period
-        )["items"]
-        for track in top_tracks:
-            # Create empty dict for holding extracted features
-            track_features = {}
+    Returns:
+        top_tracks_df (DataFrame): Top tracks in order, without duplicates.
+    """
 
-            track_features["artist"] = track["artists"][0]["name"]
-            track_features["track_name"] = track["name"]
-            track_features["popularity"] = track["popularity"]
-            track_features["explicit"] = track["explicit"]
-            # Concat the dfs
-            track_df = pd.DataFrame(track_features, index=[0])
-            top_tracks_df = pd.concat([top_tracks_df, track_df], ignore_index=True)
+    def _get_page(offset):
+        return call(
+            sp.current_user_top_tracks,
+            limit=TOP_TRACKS_PAGE_SIZE,
+            offset=offset,
+            time_range=period,
+            bucket=bucket,
+        )
 
-    return top_tracks_df
+    # The first page tells how many top tracks there are in total
+    first_page = _get_page(0)
+    offsets = range(TOP_TRACKS_PAGE_SIZE, first_page["total"], TOP_TRACKS_PAGE_SIZE)
+    pages = chain([first_page], map(_get_page, offsets))
 
+    def _iter_top_tracks():
+        seen = set()
+        for page in pages:
+            for track in page["items"]:
+                if track["id"] in seen:
+                    continue
+                seen.add(track["id"])
+                yield {
+                    "artist": track["artists"][0]["name"],
+                    "track_name": track["name"],
+                    "popularity": track["popularity"],
+                    "explicit": track["explicit"],
+                }
 
-def spotify_driver(playlist_id=None):
-    # Define the scope. You ensure that only a part of the information can be accessed.
-    """scope = "user-top-read"
-
-    sp = spotipy.Spotify(
-        auth_manager=SpotifyOAuth(
-            client_id=st.secrets["CLIENT_ID"],
-            client_secret=st.secrets["CLIENT_SECRET"],
-            redirect_uri=st.secrets["REDIRECT_URI"],
-            scope=scope,
+    return _build_frame(_iter_top_tracks(), TOP_TRACKS_COLUMNS)
+
+
+def top_tracks_driver(sp=None, directory="data/user_data", bucket=None):
+    """Download the user top tracks of all time ranges.
+
+    The three time ranges are fetched concurrently and written to
+    {directory}/top_tracks_{period}.csv.
+
+    Args:
+        sp: spotipy api handler. Defaults to the shared client with user-top-read scope.
+        directory (str or Path): Folder to write the top tracks to.
+        bucket (TokenBucket): Rate limiter shared by all API calls.
+
+    Returns:
+        report (dict): Number of top tracks per time range and number of API calls.
+    """
+    if sp is None:
+        sp = get_spotify_client("user-top-read")
+    if bucket is None:
+        bucket = TokenBucket()
+    calls_before = bucket.requests
+
+    with ThreadPoolExecutor(max_workers=len(TIME_RANGES)) as executor:
+        top_tracks = executor.map(
+            lambda period: usage_analysis(sp, period, bucket), TIME_RANGES
         )
-    )
+        top_tracks = dict(zip(TIME_RANGES, top_tracks))
+
+    report = {}
+    for period, top_tracks_df in top_tracks.items():
+        top_tracks_df.to_csv(f"{directory}/top_tracks_{period}.csv", index=False)
+        report[period] = len(top_tracks_df)
+    report["calls"] = bucket.requests - calls_before
+    print(f"Downloaded top tracks: {report}")
+    return report
+
 
-    # Long term is years of data.
-    # medium the last 6 months and short_term the last month.
-    period = "short_term"
-    top_tracks_df = usage_analysis(sp=sp, period=period)
+def open_cache():
+    """On-disk cache of API lookups, seeded from the downloaded playlists if empty.
+
+    Returns:
+        cache (SpotifyCache): The cache at its default location.
     """
-    # Define new scope for playlist analysis
+    cache = SpotifyCache()
+    if len(cache) == 0:
+        seeded = seed_from_playlists(cache)
+        print(f"Seeded the empty cache from the downloaded playlists: {seeded}")
+    return cache
+
+
+def spotify_driver(playlist_id=None, incremental=True):
+    # Define the scope. You ensure that only a part of the information can be accessed.
+    # Top tracks are downloaded by top_tracks_driver with the user-top-read scope.
     scope = "playlist-read-private"
+    sp = get_spotify_client(scope)
+
+    # Measure the API calls of this download
+    METRICS.reset()
 
-    sp = spotipy.Spotify(
-        auth_manager=SpotifyOAuth(
-            client_id=st.secrets["CLIENT_ID"],
-            client_secret=st.secrets["CLIENT_SECRET"],
-            redirect_uri=st.secrets["REDIRECT_URI"],
-            scope=scope,
+    # Cache of artist genres and audio features shared between downloads
+    cache = open_cache()
+
+    # Playlist id to download data for. The playlist is written to disk in
+    # chunks, so memory use stays flat for large playlists.
+    if incremental:
+        # Only download what changed since the last download
+        path, changes = refresh_playlist(
+            playlist_id=playlist_id, sp=sp, cache=cache, resume=True
+        )
+    else:
+        path, n_tracks = write_playlist(
+            playlist_id=playlist_id, sp=sp, cache=cache, resume=True
         )
+        print(f"Wrote {n_tracks} tracks to {path}")
+    print(f"Cache hits and misses: {cache.stats()}")
+    cache.close()
+
+    print(METRICS.summary())
+    METRICS.save(playlist_id=playlist_id, cache=cache.stats())
+
+
+def _playlist_path(directory, name, playlist_id, taken):
+    """File of a downloaded playlist, {directory}/{name}.csv unless another
+    playlist has that name. Then the playlist id is added to the file name.
+
+    Args:
+        directory (Path): Folder of the playlists.
+        name (str): Name of the playlist.
+        playlist_id (str): ID of the playlist.
+        taken (set of Path): Files of the other playlists of this run. The
+            returned file is added to it.
+
+    Returns:
+        path (Path): File to write the playlist to.
+    """
+    path = directory / f"{name}.csv"
+    meta_path = path.with_suffix(".json")
+    owner = (
+        json.loads(meta_path.read_text()).get("playlist_id")
+        if meta_path.is_file()
+        else None
     )
+    if path in taken or owner not in (None, playlist_id):
+        path = directory / f"{name}_{playlist_id}.csv"
+    taken.add(path)
+    return path
+
+
+def ingest_playlists(
+    playlist_ids,
+    sp,
+    cache=None,
+    bucket=None,
+    max_workers=MAX_WORKERS,
+    incremental=True,
+    directory="data/playlists",
+):
+    """Download many playlists in one run, enriching every track and artist once.
+
+    The playlists are listed concurrently with only their metadata fields. The
+    unique track and artist ids of all playlists are then enriched together with
+    the batch endpoints, and each playlist is written to {directory}/{name}.csv,
+    or {directory}/{name}_{playlist_id}.csv if another playlist has the name.
+    A playlist that can not be downloaded, eg. because it is private or does
+    not exist, is reported and the others are still written.
+
+    Args:
+        playlist_ids (list of str): IDs of the playlists to download.
+        sp (Spotify authentification instance): API authentification handler.
+        cache (SpotifyCache): Optional on-disk cache of artist genres and audio features.
+        bucket (TokenBucket): Rate limiter shared by all API calls.
+        max_workers (int): Maximum number of requests made at the same time.
+        incremental (bool): Skip playlists whose snapshot is unchanged since
+            they were last downloaded.
+        directory (str or Path): Folder to write the playlists to.
+
+    Returns:
+        report (dict): Written files, failed playlists with their errors,
+            number of API calls, tracks and wall time.
+    """
+    if bucket is None:
+        bucket = TokenBucket()
+    start = time.perf_counter()
+    calls_before = bucket.requests
+    directory = Path(directory)
+    playlist_ids = list(dict.fromkeys(playlist_ids))
+    failed = {}
+
+    def _info(playlist_id):
+        return call(
+            sp.playlist,
+            playlist_id,
+            fields="name,snapshot_id,tracks.total",
+            bucket=bucket,
+        )
+
+    def _list(playlist_id):
+        tracks = []
+        pages = iter_playlist_pages(
+            playlist_id,
+            playlists[playlist_id]["tracks"]["total"],
+            sp,
+            bucket,
+            max_workers=page_workers,
+            fields=PLAYLIST_ITEM_FIELDS,
+        )
+        for page in pages:
+            for track in page:
+                try:
+                    tracks.append(_get_track_metadata(track))
+                except Exception as e:
+                    print(e)
+        return tracks
 
-    # Playlist id to download data for
-    playlist_df, playlist_name = analyze_playlist(playlist_id=playlist_id, sp=sp)
+    def _or_failed(function):
+        """Run function for a playlist, recording the playlist as failed if the
+        API calls for it fail."""
 
-    # Save dataframe
-    playlist_df.to_csv(f"data/playlists/{playlist_name}.csv", index=False)
-    # top_tracks_df.to_csv(f"data/user_data/top_tracks_{period}.csv", index=False)
+        def run(playlist_id):
+            try:
+                return function(playlist_id)
+            except (spotipy.SpotifyException, requests.RequestException) as e:
+                print(f"Could not download playlist {playlist_id}: {e}")
+                failed[playlist_id] = str(e)
+                return None
+
+        return run
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        playlists = dict(
+            zip(playlist_ids, executor.map(_or_failed(_info), playlist_ids))
+        )
+        playlists = {p: playlist for p, playlist in playlists.items() if playlist}
+
+        # Files of the playlists, in the order they were given
+        taken = set()
+        paths = {
+            playlist_id: _playlist_path(directory, playlist["name"], playlist_id, taken)
+            for playlist_id, playlist in playlists.items()
+        }
+
+        # Skip the playlists that have not changed since the last download
+        skipped = []
+        if incremental:
+            for playlist_id, playlist in playlists.items():
+                meta_path = paths[playlist_id].with_suffix(".json")
+                if (
+                    meta_path.is_file()
+                    and paths[playlist_id].is_file()
+                    and json.loads(meta_path.read_text())["snapshot_id"]
+                    == playlist.get("snapshot_id")
+                ):
+                    skipped.append(playlist_id)
+        changed = [p for p in playlists if p not in skipped]
+
+        # List several playlists at a time, while keeping the total number of
+        # requests in flight at max_workers
+        listing_workers = max(1, min(len(changed), max_workers))
+        page_workers = max(1, max_workers // listing_workers)
+        with ThreadPoolExecutor(max_workers=listing_workers) as listing_executor:
+            tracks = dict(
+                zip(changed, listing_executor.map(_or_failed(_list), changed))
+            )
+        changed = [p for p in changed if tracks[p] is not None]
+
+        # Enrich each unique track and artist once across all playlists. The
+        # genres of all artists are looked up first, so _enrich_tracks finds
+        # them resolved.
+        all_tracks = list(chain.from_iterable(tracks[p] for p in changed))
+        artist_ids = list(dict.fromkeys(t["artist_id"] for t in all_tracks))
+        artist_genres = {}
+        for genres in executor.map(
+            lambda batch: get_artist_genres(batch, sp, cache, bucket),
+            _batches(artist_ids, ARTISTS_BATCH_SIZE),
+        ):
+            artist_genres.update(genres)
+        # Chunks of one batch of unique track ids, with every copy of them
+        by_track = {}
+        for track in all_tracks:
+            by_track.setdefault(track["track_id"], []).append(track)
+        chunks = [
+            list(chain.from_iterable(copies))
+            for copies in _batches(list(by_track.values()), AUDIO_FEATURES_BATCH_SIZE)
+        ]
+        list(
+            executor.map(
+                lambda chunk: _enrich_tracks(chunk, sp, artist_genres, cache, bucket),
+                chunks,
+            )
+        )
+
+    written = []
+    for playlist_id in changed:
+        playlist_df = _build_frame(tracks[playlist_id], PLAYLIST_COLUMNS)
+        path = paths[playlist_id]
+        playlist_df.to_csv(path, index=False)
+        _write_playlist_meta(
+            path, playlist_id, playlists[playlist_id].get("snapshot_id"), playlist_df
+        )
+        written.append(path)
+
+    seconds = time.perf_counter() - start
+    report = {
+        "written": [str(path) for path in written],
+        "skipped": skipped,
+        "failed": failed,
+        "calls": bucket.requests - calls_before,
+        "tracks": len(all_tracks),
+        "unique_tracks": len(by_track),
+        "unique_artists": len(artist_ids),
+        "seconds": seconds,
+        "tracks_per_second": len(all_tracks) / seconds if seconds else 0.0,
+    }
+    return report
+
+
+def main(argv=None):
+    """Command line entry point for downloading many playlists in one run."""
+    parser = argparse.ArgumentParser(
+        description="Download playlist data to data/playlists/{name}.csv",
+        epilog="Example: python spotify.py 3PDP5gjPxjiXfYbgf8ll9C 3vmJSGD3GyrWBdTrpNazPs",
+    )
+    parser.add_argument("playlist_ids", nargs="*", help="IDs of playlists to download")
+    parser.add_argument(
+        "-f", "--file", help="File with one playlist id per line. # starts a comment"
+    )
+    parser.add_argument(
+        "-w", "--workers", type=int, default=MAX_WORKERS, help="Concurrent requests"
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Download all playlists, also those unchanged since the last download",
+    )
+    parser.add_argument(
+        "--top-tracks",
+        action="store_true",
+        help="Also download the user top tracks to data/user_data",
+    )
+    args = parser.parse_args(argv)
+
+    playlist_ids = list(args.playlist_ids)
+    if args.file:
+        for line in Path(args.file).read_text().splitlines():
+            line = line.split("#")[0].strip()
+            if line:
+                playlist_ids.append(line)
+    METRICS.reset()
+    if args.top_tracks:
+        top_tracks_driver()
+    if not playlist_ids:
+        if args.top_tracks:
+            return None
+        parser.error("No playlist ids given")
+
+    sp = get_spotify_client("playlist-read-private")
+    cache = open_cache()
+    report = ingest_playlists(
+        playlist_ids,
+        sp,
+        cache=cache,
+        max_workers=args.workers,
+        incremental=not args.full,
+    )
+    cache.close()
+
+    for path in report["written"]:
+        print(f"Wrote {path}")
+    print(
+        f"{len(report['written'])} playlists written, {len(report['skipped'])} unchanged. "
+        f"{report['tracks']} tracks ({report['unique_tracks']} unique, "
+        f"{report['unique_artists']} artists) in {report['seconds']:.1f} s "
+        f"({report['tracks_per_second']:.0f} tracks/s) using {report['calls']} API calls"
+    )
+    if report["failed"]:
+        print(f"{len(report['failed'])} playlists failed:")
+        for playlist_id, error in report["failed"].items():
+            print(f"  {playlist_id}: {error}")
+    print(f"Cache hits and misses: {cache.stats()}")
+    print(METRICS.summary())
+    METRICS.save(playlist_ids=playlist_ids, cache=cache.stats())
+    return report
 
 
 if __name__ == "__main__":
     # $ id = 3PDP5gjPxjiXfYbgf8ll9C
     # tec : 3vmJSGD3GyrWBdTrpNazPs
-
-    playlist_id = "3PDP5gjPxjiXfYbgf8ll9C"
-    spotify_driver(playlist_id=playlist_id)
+    main()
@@ -1,107 +1,726 @@
+import argparse
+import functools
+import hashlib
+import json
+import shutil
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import streamlit as st
 
+from util.column_store import (
+    column_store_version,
+    read_column_store,
+    write_column_store,
+)
+from util.figure_cache import FigureCache
+from util.query import DuckDBQueries, PandasQueries
+from util.remote_cache import RemoteFileCache
+from util.rollup import DailyRollup, aggregate_plays
+from util.schema import (
+    STREAMING_OPTIONAL,
+    STREAMING_SCHEMA,
+    apply_schema,
+    arrow_schema,
+    read_csv,
+    track_titles,
+)
 
-def convert_stream_data():
-    path = Path("data/MyData").rglob("*endsong*.json")
-    stream_df = pd.concat((pd.read_json(f, convert_dates=["ts"]) for f in path))
+# Columnar store of the streaming history, a folder of parquet files
+STREAMING_STORE = Path("data/streaming_store")
 
-    stream_df.rename(
-        columns={
-            "ts": "endTime",
-            "master_metadata_track_name": "trackName",
-            "master_metadata_album_artist_name": "artistName",
-            "master_metadata_album_album_name": "albumName",
-        },
-        inplace=True,
+# Plays before the first streaming history update, the account data export
+STREAMING_HISTORY = Path("data/total_streaming_data_pre2023.csv")
+
+# Single file version of the store that is uploaded to the bucket
+STREAMING_EXPORT = Path("data/total_streaming_data.parquet")
+REMOTE_STREAMING_DATA = "bucket_total_streaming_data/total_streaming_data.parquet"
+# Read instead until the export of the store has been uploaded to the bucket
+REMOTE_STREAMING_CSV = "bucket_total_streaming_data/total_streaming_data.csv"
+
+# Columns used by the app. Only these are read from the store.
+STREAMING_COLUMNS = list(STREAMING_SCHEMA)
+
+# Arrow schema of the store, so that all chunks are written with the same types
+STORE_SCHEMA = arrow_schema(STREAMING_SCHEMA)
+
+# Field names in the extended streaming history (endsong) and account data
+# (StreamingHistory) exports of each of the STREAMING_COLUMNS
+EXTENDED_FIELDS = {
+    "endTime": "ts",
+    "trackName": "master_metadata_track_name",
+    "artistName": "master_metadata_album_artist_name",
+}
+ACCOUNT_FIELDS = {"ms_played": "msPlayed"}
+
+# Columns identifying a play, used to drop duplicates when merging exports
+PLAY_KEY_COLUMNS = ["endTime", "trackName", "artistName", "ms_played"]
+
+# Files a partition may hold before it is compacted into one, so reading a
+# partition does not get slower with every update
+COMPACT_AFTER = 8
+
+# Merged export files and latest play in the store
+MANIFEST_NAME = "_manifest.json"
+
+# Daily plays per track and artist, updated at every write to the store
+ROLLUP_NAME = "_rollup.parquet"
+
+# Memory-mapped column stores of the loaded streaming history, one folder per
+# dataset version, shared by all server processes on the host
+COLUMN_STORES = Path("data/.streaming_columns")
+# Increased when the columns of the mapped frames change, eg. a derived column
+MAPPED_LAYOUT = 1
+# Column stores older than the current one that are kept, since other server
+# processes may still be loading them
+MAPPED_KEEP_PREVIOUS = 1
+
+
+def _compact_types(df):
+    """Convert streaming data to the compact types of the streaming schema."""
+    # Missing in the account data export and in old plays of the extended export
+    if "shuffle" in df.columns and df["shuffle"].dtype != bool:
+        df = df.assign(shuffle=df["shuffle"].eq(True))
+    if "skipped" in df.columns and df["skipped"].dtype == object:
+        df = df.assign(skipped=df["skipped"].astype("float32"))
+    return apply_schema(df, STREAMING_SCHEMA, STREAMING_OPTIONAL, "streaming data")
+
+
+def _write_parquet(df, path):
+    """Write a frame of compact streaming data with the store schema."""
+    table = pa.Table.from_pandas(
+        df[STREAMING_COLUMNS], schema=STORE_SCHEMA, preserve_index=False
     )
+    pq.write_table(table, path)
 
-    # Select only non_sensitive data to upload
-    stream_df = stream_df[
-        [
-            "endTime",
-            "ms_played",
-            "trackName",
-            "artistName",
-            "reason_start",
-            "reason_end",
-            "shuffle",
-            "skipped",
-        ]
-    ]
 
-    stream_df.to_csv("data/total_streaming_data.csv")
+def _write_partitioned(df, path, name):
+    """Write compact streaming data to the year/month partitions of the store.
+
+    Args:
+        df (DataFrame): Compact streaming data.
+        path (Path): Folder of the store.
+        name (str): Name of the written file in each partition.
+    """
+    end_time = df["endTime"]
+    for (year, month), rows in df.groupby([end_time.dt.year, end_time.dt.month]):
+        partition = path / f"year={year}" / f"month={month:02d}"
+        partition.mkdir(parents=True, exist_ok=True)
+        _write_parquet(rows, partition / f"{name}.parquet")
+
+
+def _compact_partition(partition, name):
+    """Rewrite the files of a partition as one time sorted file.
+
+    Args:
+        partition (Path): Folder of the partition.
+        name (str): Name of the compacted file, not used by any of the files.
+    """
+    parts = sorted(partition.glob("*.parquet"))
+    rows = read_streaming_store(partition)
+    # Not matched by the readers of the store until it is renamed
+    tmp = partition / f".{name}.parquet.tmp"
+    _write_parquet(rows, tmp)
+    tmp.rename(partition / f"{name}.parquet")
+    for part in parts:
+        part.unlink()
+
+
+def _clear_store(path):
+    """Create an empty store, removing all existing data."""
+    path.mkdir(parents=True, exist_ok=True)
+    for part in path.glob("**/*.parquet"):
+        part.unlink()
+    (path / MANIFEST_NAME).unlink(missing_ok=True)
+    (path / ROLLUP_NAME).unlink(missing_ok=True)
+
+
+def _read_manifest(path):
+    manifest = path / MANIFEST_NAME
+    if not manifest.is_file():
+        return {"files": {}, "watermark": None, "merges": 0}
+    return json.loads(manifest.read_text())
+
+
+def _write_manifest(path, manifest):
+    # Write and rename, so an interrupted write does not corrupt the manifest
+    tmp = path / f"{MANIFEST_NAME}.tmp"
+    tmp.write_text(json.dumps(manifest, indent=2))
+    tmp.replace(path / MANIFEST_NAME)
+
+
+def _write_rollup(path, rows):
+    """Write the daily rollup of the store, adding up rows of the same day."""
+    DailyRollup(rows).rows.to_parquet(path / ROLLUP_NAME, index=False)
+
+
+def read_daily_rollup(path=STREAMING_STORE):
+    """Read the daily rollup written at ingest.
+
+    Args:
+        path (Path): Folder of the store.
+
+    Returns:
+        rollup (DailyRollup): Daily plays of the store. None if the store has none.
+    """
+    if not (path / ROLLUP_NAME).is_file():
+        return None
+    return DailyRollup(pd.read_parquet(path / ROLLUP_NAME))
 
-    path = Path("data/playlists").rglob("*.csv")
-    playlist_df = pd.concat((pd.read_csv(f) for f in path))
 
-    return stream_df
+def store_version(path=STREAMING_STORE):
+    """Identifier of the data in the store, changed by every write."""
+    manifest = _read_manifest(path)
+    return (
+        f"store-{manifest['watermark']}-{manifest['merges']}-{len(manifest['files'])}"
+    )
+
+
+def dataset_version(df):
+    """Identifier of the streaming history in a frame, to cache results per dataset.
+
+    Set by the loaders. pandas copies attrs to frames derived from the loaded
+    one, so the version is only used if the frame has all its rows. For other
+    frames it is computed from the play times and ms_played.
+    """
+    version = df.attrs.get("version")
+    if version is None or df.attrs.get("rows") != len(df):
+        hashes = pd.util.hash_pandas_object(df[["endTime", "ms_played"]], index=False)
+        version = f"hash-{len(df)}-{int(hashes.sum()):x}"
+    return version
+
+
+def _file_key(path):
+    """Identifies an export file that has already been merged."""
+    stat = path.stat()
+    return f"{path.name}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def _play_keys(df):
+    """Stable 64 bit hash of each play, the same across processes and runs."""
+    return pd.util.hash_pandas_object(df[PLAY_KEY_COLUMNS], index=False).to_numpy()
 
 
-def convert_stream_data_update():
-    dtypes = {
-        "ms_played": "int",
-        "trackName": "str",
-        "artistName": "str",
-        "reason_start": "str",
-        "reason_end": "str",
-        "shuffle": "bool",
-        "skipped": "float",
-    }
+def write_streaming_store(stream_df, path=STREAMING_STORE, export=STREAMING_EXPORT):
+    """Write streaming data to the columnar store.
 
-    path = Path("data/MyData_update").rglob("StreamingH*.json")
-    stream_df = pd.concat(
-        (pd.read_json(f, convert_dates="endTime", dtype=dtypes) for f in path)
+    Args:
+        stream_df (DataFrame): Streaming data with the STREAMING_COLUMNS.
+        path (Path): Folder of the store. Existing data in it is replaced.
+        export (Path): Single file copy of the store for uploading to the bucket.
+            Not written if None.
+    """
+    stream_df = _compact_types(stream_df)
+    _clear_store(path)
+    _write_partitioned(stream_df, path, "part-00000")
+    _write_rollup(path, aggregate_plays(stream_df))
+    manifest = _read_manifest(path)
+    manifest["watermark"] = int(stream_df["endTime"].max().value)
+    _write_manifest(path, manifest)
+    if export is not None:
+        export_streaming_store(path, export)
+
+
+def read_streaming_store(path=STREAMING_STORE, columns=STREAMING_COLUMNS):
+    """Read the columns of the streaming data store.
+
+    Args:
+        path (Path): Folder or file of the store.
+        columns (list of str): Columns to read. The other columns are not loaded.
+
+    Returns:
+        df (DataFrame): Streaming data with dictionary encoded string columns.
+    """
+    df = pd.read_parquet(path, columns=columns)
+    return sort_by_time(
+        apply_schema(df, STREAMING_SCHEMA, STREAMING_OPTIONAL, str(path))
     )
 
-    stream_df.rename(
-        columns={
-            "msPlayed": "ms_played",
+
+def sort_by_time(df):
+    """Sort plays by endTime, so time ranges can be binary searched with a
+    util.timeindex.TimeIndex. Sorted frames are returned as they are."""
+    if df["endTime"].is_monotonic_increasing:
+        return df
+    return df.sort_values("endTime", kind="stable", ignore_index=True)
+
+
+def _prepare_remote(df, path=REMOTE_STREAMING_DATA):
+    """Types and order of the streaming history read from the bucket."""
+    df = apply_schema(df, STREAMING_SCHEMA, STREAMING_OPTIONAL, path)
+    return sort_by_time(df)
+
+
+def _iter_json_array(f, read_size=1 << 20):
+    """Parse a JSON array incrementally and yield its elements.
+
+    Only read_size characters plus one element are held in memory at a time.
+
+    Args:
+        f (file): Text file containing a JSON array.
+        read_size (int): Number of characters read at a time.
+
+    Yields:
+        element: Each decoded element of the array.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    started = False
+    while True:
+        chunk = f.read(read_size)
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+        if not started:
+            stripped = buffer.lstrip()
+            if not stripped:
+                if not chunk:
+                    return
+                continue
+            if stripped[0] != "[":
+                raise ValueError(f"{f.name} does not contain a JSON array")
+            pos = len(buffer) - len(stripped) + 1
+            started = True
+
+        while True:
+            # Skip the separators between elements
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= len(buffer):
+                break
+            if buffer[pos] == "]":
+                return
+            try:
+                element, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # Element continues in the next chunk
+                break
+            yield element
+
+        if not chunk:
+            raise ValueError(f"Unexpected end of JSON array in {f.name}")
+
+
+def _iter_export_chunks(path, chunk_size):
+    """Read a streaming history export file in chunks of compact streaming data.
+
+    Both the extended streaming history (endsong) and the account data
+    (StreamingHistory) formats are supported. Only the STREAMING_COLUMNS are kept.
+
+    Args:
+        path (Path): JSON export file.
+        chunk_size (int): Maximum number of plays per chunk.
+
+    Yields:
+        chunk (DataFrame): Compact streaming data.
+    """
+    columns = {column: [] for column in STREAMING_COLUMNS}
+    n_rows = 0
+    with open(path, encoding="utf-8") as f:
+        for record in _iter_json_array(f):
+            fields = EXTENDED_FIELDS if "ts" in record else ACCOUNT_FIELDS
+            for column in STREAMING_COLUMNS:
+                columns[column].append(record.get(fields.get(column, column)))
+            n_rows += 1
+            if n_rows % chunk_size == 0:
+                yield _compact_types(pd.DataFrame(columns))
+                for values in columns.values():
+                    values.clear()
+    if n_rows % chunk_size:
+        yield _compact_types(pd.DataFrame(columns))
+
+
+def _ingest_export_file(path, directory, chunk_size):
+    """Convert one streaming history export file to parquet chunks in the store.
+
+    Args:
+        path (Path): JSON export file.
+        directory (Path): Folder of the store.
+        chunk_size (int): Maximum number of plays per written chunk.
+
+    Returns:
+        n_rows (int): Number of plays written.
+        watermark (int): Latest endTime in the file, in ns since the epoch.
+        rollup (DataFrame): Daily rollup rows of the plays in the file.
+    """
+    n_rows = 0
+    watermark = None
+    rollups = []
+    for i, chunk in enumerate(_iter_export_chunks(path, chunk_size)):
+        _write_partitioned(chunk, directory, f"part-{path.stem}-{i:05d}")
+        rollups.append(aggregate_plays(chunk))
+        n_rows += len(chunk)
+        latest = int(chunk["endTime"].max().value)
+        watermark = latest if watermark is None else max(watermark, latest)
+    rollup = DailyRollup(pd.concat(rollups)).rows if rollups else None
+    return n_rows, watermark, rollup
+
+
+def convert_stream_data(
+    export_dir="data/MyData",
+    pattern="*endsong*.json",
+    max_workers=None,
+    chunk_size=100_000,
+    path=STREAMING_STORE,
+    export=STREAMING_EXPORT,
+):
+    """Convert the streaming history export to the columnar store.
+
+    The export files are parsed incrementally in parallel processes, and each
+    process writes chunks of at most chunk_size plays to the store. Peak memory
+    is bounded by the chunk size and number of workers, not the size of the export.
+
+    Args:
+        export_dir (str or Path): Folder of the export.
+        pattern (str): Glob pattern of the export files.
+        max_workers (int): Number of processes. Defaults to the number of cpus.
+        chunk_size (int): Maximum number of plays per written chunk.
+        path (Path): Folder of the store. Existing data in it is replaced.
+        export (Path): Single file copy of the store for uploading to the bucket.
+            Not written if None.
+
+    Returns:
+        n_rows (int): Number of plays written to the store.
+    """
+    files = sorted(Path(export_dir).rglob(pattern))
+    _clear_store(path)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = list(
+            executor.map(
+                _ingest_export_file,
+                files,
+                [path] * len(files),
+                [chunk_size] * len(files),
+            )
+        )
+    n_rows = sum(n for n, _, _ in results)
+    watermarks = [watermark for _, watermark, _ in results if watermark is not None]
+    rollups = [rollup for _, _, rollup in results if rollup is not None]
+    if rollups:
+        _write_rollup(path, pd.concat(rollups))
+    _write_manifest(
+        path,
+        {
+            "files": {_file_key(f): n for f, (n, _, _) in zip(files, results)},
+            "watermark": max(watermarks, default=None),
+            "merges": 0,
         },
-        inplace=True,
     )
+    print(f"Converted {n_rows} plays from {len(files)} files")
+
+    if export is not None:
+        export_streaming_store(path, export)
+    return n_rows
+
+
+def export_streaming_store(path=STREAMING_STORE, export=STREAMING_EXPORT):
+    """Write the store as the single parquet file that is uploaded to the bucket.
+
+    The partitions are copied one month at a time in time order, and each is
+    sorted by endTime, so the export is sorted while memory stays bounded.
+    """
+    with pq.ParquetWriter(export, STORE_SCHEMA) as writer:
+        for partition in sorted(path.glob("year=*/month=*")):
+            month = sort_by_time(read_streaming_store(partition))
+            writer.write_table(
+                pa.Table.from_pandas(month, schema=STORE_SCHEMA, preserve_index=False)
+            )
+
+
+def merge_streaming_data(stream_df, path=STREAMING_STORE):
+    """Append the plays that are not in the store yet.
+
+    Duplicates are found by a stable hash of the PLAY_KEY_COLUMNS. Only the
+    partitions that new plays fall into are read, and plays after the watermark,
+    the latest play in the store, are known to be new without reading anything.
+    A partition with more than COMPACT_AFTER files is compacted into one.
+
+    Args:
+        stream_df (DataFrame): Streaming data with the STREAMING_COLUMNS.
+        path (Path): Folder of the store.
+
+    Returns:
+        n_rows (int): Number of plays added to the store.
+    """
+    stream_df = _compact_types(stream_df[STREAMING_COLUMNS])
+    keys = _play_keys(stream_df)
+    unique = ~pd.Series(keys).duplicated().to_numpy()
+    stream_df, keys = stream_df[unique], keys[unique]
+
+    path.mkdir(parents=True, exist_ok=True)
+    manifest = _read_manifest(path)
+    watermark = manifest["watermark"]
+    merge = manifest["merges"] + 1
+    name = f"delta-{merge:05d}"
+
+    n_rows = 0
+    added = []
+    end_time = stream_df["endTime"]
+    for (year, month), index in stream_df.groupby(
+        [end_time.dt.year, end_time.dt.month]
+    ).indices.items():
+        rows = stream_df.iloc[index]
+        partition = path / f"year={year}" / f"month={month:02d}"
+        if (
+            watermark is not None
+            and rows["endTime"].min().value <= watermark
+            and partition.is_dir()
+        ):
+            existing = _play_keys(pd.read_parquet(partition, columns=PLAY_KEY_COLUMNS))
+            rows = rows[~np.isin(keys[index], existing)]
+        if len(rows):
+            partition.mkdir(parents=True, exist_ok=True)
+            _write_parquet(rows, partition / f"{name}.parquet")
+            added.append(aggregate_plays(rows))
+            n_rows += len(rows)
+            if len(list(partition.glob("*.parquet"))) > COMPACT_AFTER:
+                _compact_partition(partition, f"part-{merge:05d}")
+
+    if n_rows:
+        # The rollup is additive, so only the new plays are aggregated
+        rollup = read_daily_rollup(path)
+        _write_rollup(path, pd.concat(added + ([rollup.rows] if rollup else [])))
+        latest = int(end_time.max().value)
+        manifest["watermark"] = latest if watermark is None else max(watermark, latest)
+        manifest["merges"] = merge
+        _write_manifest(path, manifest)
+    return n_rows
+
+
+def _seed_streaming_store(history, path):
+    """Merge the older streaming history into an empty store.
+
+    Returns:
+        n_rows (int): Number of plays added to the store.
+
+    Raises:
+        FileNotFoundError: If history does not exist.
+    """
+    if not Path(history).is_file():
+        raise FileNotFoundError(
+            f"The store {path} is empty and the older streaming history {history} "
+            "does not exist. Put the history there, or pass history=None to build "
+            "the store from the update alone."
+        )
+    # The account data history has none of the optional columns
+    history_df = read_streaming_csv(history).reindex(columns=STREAMING_COLUMNS)
+    n_rows = merge_streaming_data(history_df, path)
+    print(f"Seeded the store with {n_rows} plays of {history}")
+    return n_rows
+
+
+def convert_stream_data_update(
+    export_dir="data/MyData_update",
+    pattern="StreamingH*.json",
+    path=STREAMING_STORE,
+    export=None,
+    history=STREAMING_HISTORY,
+):
+    """Merge a new streaming history export into the columnar store.
+
+    Export files that were merged before are skipped, so rerunning on the same
+    export does nothing. The cost of an update depends on the size of the new
+    export, not on the size of the store, unless the single file export is
+    asked for, which copies the whole store. An empty store is first seeded
+    with the older history, so the store and its export hold all plays.
+
+    Args:
+        export_dir (str or Path): Folder of the new export.
+        pattern (str): Glob pattern of the export files.
+        path (Path): Folder of the store.
+        export (Path): Single file copy of the store for uploading to the bucket,
+            eg. STREAMING_EXPORT. Only rewritten if plays were added or it does
+            not exist. Not written if None.
+        history (str or Path): Csv file of the plays before the first update,
+            merged if the store is empty. The store is built from the update
+            alone if None.
+
+    Returns:
+        n_rows (int): Number of plays added to the store.
 
-    original_df = pd.read_csv(
-        "data/total_streaming_data_pre2023.csv", parse_dates=["endTime"], dtype=dtypes
+    Raises:
+        FileNotFoundError: If the store is empty and history does not exist.
+    """
+    manifest = _read_manifest(path)
+    seeded = 0
+    if manifest["watermark"] is None and history is not None:
+        seeded = _seed_streaming_store(history, path)
+        manifest = _read_manifest(path)
+    files = [
+        f
+        for f in sorted(Path(export_dir).rglob(pattern))
+        if _file_key(f) not in manifest["files"]
+    ]
+    n_rows = 0
+    if not files:
+        print("No new export files to merge")
+    else:
+        # Files with an empty array have no chunks, and are only recorded
+        frames = {}
+        for f in files:
+            chunks = list(_iter_export_chunks(f, chunk_size=100_000))
+            frames[f] = pd.concat(chunks) if chunks else None
+        stream_frames = [df for df in frames.values() if df is not None]
+        if stream_frames:
+            stream_df = pd.concat(stream_frames)
+            n_rows = merge_streaming_data(stream_df, path)
+            print(
+                f"Merged {n_rows} new plays of {len(stream_df)} "
+                f"from {len(files)} files"
+            )
+
+        # Empty files of an empty store are not recorded, there is no store yet
+        if path.is_dir():
+            # Reread, since the merge updated the watermark
+            manifest = _read_manifest(path)
+            manifest["files"].update(
+                {_file_key(f): 0 if df is None else len(df) for f, df in frames.items()}
+            )
+            _write_manifest(path, manifest)
+
+    n_rows += seeded
+
+    if export is not None and (n_rows or not Path(export).is_file()):
+        export_streaming_store(path, export)
+    return n_rows
+
+
+def _prune_column_stores(current):
+    """Remove the column stores older than current, except the newest
+    MAPPED_KEEP_PREVIOUS of them. Stores written after current are kept."""
+    stores = []
+    for store in COLUMN_STORES.iterdir():
+        # Temporary folders of other writers start with a dot
+        if store == current or store.name.startswith("."):
+            continue
+        try:
+            stores.append((store.stat().st_mtime, store))
+        except FileNotFoundError:
+            # Removed by another process
+            continue
+    newest = current.stat().st_mtime
+    older = sorted(
+        ((mtime, store) for mtime, store in stores if mtime <= newest), reverse=True
     )
-    # total = pd.merge(stream_df, playlist_df, on='track_name')
+    for _, store in older[MAPPED_KEEP_PREVIOUS:]:
+        shutil.rmtree(store, ignore_errors=True)
+
 
-    # convert the 'Date' column to datetime format
-    stream_df["endTime"] = pd.to_datetime(stream_df["endTime"])
-    original_df["endTime"] = pd.to_datetime(original_df["endTime"])
+@st.cache_resource(max_entries=2)
+def get_mapped_streaming_df(version, _load):
+    """Streaming history of a dataset version as memory-mapped columns.
 
-    # Combine
-    combined = pd.concat([original_df, stream_df])
+    The column store of the version is written by the first process that asks
+    for it, from the frame returned by _load. All other processes map the same
+    files, so the data is held once per host, in the page cache. Stores of
+    older versions are removed, except the previous one, which other processes
+    may still be loading. If the store is removed before it is read, it is
+    written again.
 
-    # Add timezone to the new rows. This is just set to zero. '
-    combined["endTime"] = pd.to_datetime(combined["endTime"], utc=True)
-    combined.to_csv("data/tmp.csv")
+    Args:
+        version (str): Version of the data, eg. as returned by store_version.
+        _load (callable): Returns the data if there is no store of the version.
 
-    return stream_df
+    Returns:
+        df (DataFrame): Streaming history of read-only arrays, which must not
+            be modified in place, with the trackTitle column of track_titles.
+            It is shared by all sessions, so derived columns are added with
+            assign, and writing to a view of it raises ValueError.
+    """
+    key = f"{version}/{MAPPED_LAYOUT}"
+    directory = COLUMN_STORES / hashlib.sha1(key.encode()).hexdigest()[:16]
+    for attempt in range(3):
+        if column_store_version(directory) != version:
+            df = _load()
+            # Derived once per version, over the distinct track names
+            df = df.assign(trackTitle=track_titles(df["trackName"]))
+            write_column_store(df, directory, version)
+            _prune_column_stores(directory)
+        try:
+            return read_column_store(directory)
+        except FileNotFoundError:
+            if attempt == 2:
+                raise
+            print(
+                f"Column store {directory} was removed while loading, writing it again"
+            )
+
+
+def read_streaming_csv(path):
+    """Read streaming history from a csv file, sorted by endTime."""
+    return sort_by_time(read_csv(path, STREAMING_SCHEMA, STREAMING_OPTIONAL))
 
 
-@st.cache_data
 def get_streaming_df():
     data = Path("data/total_streaming_data.csv")
-    if data.is_file():
-        dtypes = {
-            "ms_played": "int",
-            "trackName": "str",
-            "artistName": "str",
-            "reason_start": "str",
-            "reason_end": "str",
-            "shuffle": "bool",
-            "skipped": "float",
-        }
-        df = pd.read_csv(
-            "data/total_streaming_data.csv", parse_dates=["endTime"], dtype=dtypes
-        )
+    if STREAMING_STORE.is_dir():
+        version, load = store_version(), read_streaming_store
     else:
-        print("Data not available. Using small dataset instead")
-        df = pd.read_csv("data/streaming_data.csv", parse_dates=["endTime"])
-    return df
+        if not data.is_file():
+            print("Data not available. Using small dataset instead")
+            data = Path("data/streaming_data.csv")
+        version = f"csv-{_file_key(data)}"
+        load = functools.partial(read_streaming_csv, data)
+    return get_mapped_streaming_df(version, load)
+
+
+@st.cache_resource(max_entries=2)
+def get_daily_rollup(_df, version):
+    """Daily rollup of a streaming history, computed once per dataset version.
+
+    The rollup written at ingest is used if the data comes from the store.
+
+    Args:
+        _df (DataFrame): Streaming history. Not hashed, the version identifies it.
+        version (str): Version of the data as returned by dataset_version.
+
+    Returns:
+        rollup (DailyRollup): Daily plays per track and artist.
+    """
+    if version == store_version() and (STREAMING_STORE / ROLLUP_NAME).is_file():
+        return read_daily_rollup()
+    return DailyRollup.from_plays(_df)
+
+
+@st.cache_resource(max_entries=2)
+def get_streaming_queries(_df, version, backend="duckdb"):
+    """Query backend of the streaming plots, created once per dataset version.
+
+    The plots query the store with DuckDB if the data comes from the store and
+    duckdb is installed, and the history in memory with pandas otherwise.
+
+    Args:
+        _df (DataFrame): Streaming history. Not hashed, the version identifies it.
+        version (str): Version of the data as returned by dataset_version.
+        backend (str): "duckdb" or "pandas".
+
+    Returns:
+        queries (PandasQueries or DuckDBQueries): The backend.
+    """
+    if backend == "duckdb" and version == store_version():
+        try:
+            return DuckDBQueries(STREAMING_STORE)
+        except ImportError:
+            print("duckdb is not installed. Using pandas queries instead")
+    return PandasQueries(_df, get_daily_rollup(_df, version))
+
+
+@st.cache_resource
+def get_figure_cache():
+    """Cache of built figures shared by all sessions of the server process."""
+    return FigureCache()
+
+
+@st.cache_resource
+def get_remote_cache(_fs):
+    """Cache of bucket files shared by all sessions of the server process."""
+    return RemoteFileCache(_fs)
 
 
 def get_streaming_df_remote():
@@ -113,38 +732,46 @@ def get_streaming_df_remote():
         df = df[0:100]
         return df
 
-    dtypes = {
-        "ms_played": "int",
-        "trackName": "str",
-        "artistName": "str",
-        "reason_start": "str",
-        "reason_end": "str",
-        "shuffle": "bool",
-        "skipped": "float",
-    }
-
-    # Create connection object and retrieve file contents.
-    # Specify input format is a csv and to cache the result for 600 seconds.
+    # Create connection object and read the file through the local cache,
+    # which only downloads it again when the object in the bucket has changed.
     conn = st.connection("gcs", type=FilesConnection)
-    df = conn.read(
-        "bucket_total_streaming_data/total_streaming_data.csv",
-        input_format="csv",
-        ttl=600,
-        parse_dates=["endTime"],
-        dtype=dtypes,
-    )
+    cache = get_remote_cache(conn.fs)
+    # The parquet export is written with python streaming_data.py --export and
+    # uploaded with
+    # gsutil cp data/total_streaming_data.parquet gs://bucket_total_streaming_data/
+    # Until then the csv is read.
+    try:
+        path = REMOTE_STREAMING_DATA
+        version = cache.version(path)
+    except FileNotFoundError:
+        path = REMOTE_STREAMING_CSV
+        version = cache.version(path)
+    version = f"remote-{version}"
 
-    return df
+    def load():
+        local, _ = cache.local_file(path)
+        # The csv has none of the optional columns
+        names = pq.read_schema(local).names
+        columns = [c for c in STREAMING_COLUMNS if c in names]
+        return _prepare_remote(pd.read_parquet(local, columns=columns), path)
+
+    # Parsed once per version and host, then memory-mapped by every process
+    return get_mapped_streaming_df(version, load)
 
 
 if __name__ == "__main__":
-    test = get_streaming_google_cloud()
-    dtypes = {
-        "ms_played": "int",
-        "trackName": "str",
-        "artistName": "str",
-        "reason_start": "str",
-        "reason_end": "str",
-        "skipped": "float",
-    }
-    convert_stream_data_update()
+    parser = argparse.ArgumentParser(
+        description="Merge a new streaming history export into the store"
+    )
+    parser.add_argument(
+        "export_dir", nargs="?", default="data/MyData_update", help="Export folder"
+    )
+    parser.add_argument(
+        "--export",
+        action="store_true",
+        help=f"Also write the store to {STREAMING_EXPORT} for uploading to the bucket",
+    )
+    args = parser.parse_args()
+    convert_stream_data_update(
+        args.export_dir, export=STREAMING_EXPORT if args.export else None
+    )
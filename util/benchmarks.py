@@ -0,0 +1,804 @@
+"""Benchmarks for the data pipelines of the dashboard.
+
+Each benchmark prints its results and returns them as a dict. Run them from the
+repo root, e.g.::
+
+    $ python -m util.benchmarks playlist_calls
+"""
+import functools
+import json
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import spotipy
+
+from plotting import (
+    get_most_played_animation,
+    get_streaming_barplot,
+    get_temporal_distribution,
+)
+from spotify import (
+    AUDIO_FEATURES,
+    analyze_playlist,
+    fetch_playlist_pages,
+    ingest_playlists,
+)
+from streaming_data import (
+    _compact_types,
+    merge_streaming_data,
+    read_daily_rollup,
+    read_streaming_store,
+    sort_by_time,
+    write_streaming_store,
+)
+from util.cache import SpotifyCache
+from util.column_store import write_column_store
+from util.figure_cache import FigureCache
+from util.mock_api import MockSpotifyAPI
+from util.query import (
+    WEEKDAY_COLUMNS,
+    DuckDBQueries,
+    PandasQueries,
+    check_backends,
+    rollup_keys,
+    top_plays,
+    track_artist_keys,
+)
+from util.ratelimit import TokenBucket
+from util.rollup import DailyRollup
+from util.timeindex import TimeIndex
+
+
+def _per_track_enrichment(playlist_id, sp):
+    """Reference implementation of the original ingestion that looked up audio
+    features and artist genres once per track."""
+    playlist_length = sp.playlist(playlist_id)["tracks"]["total"]
+    for offset in range(0, playlist_length, 100):
+        items = sp.playlist_items(playlist_id=playlist_id, limit=100, offset=offset)[
+            "items"
+        ]
+        for track in items:
+            audio_features = sp.audio_features(track["track"]["id"])[0]
+            _ = [audio_features[feature] for feature in AUDIO_FEATURES]
+            try:
+                _ = sp.artist(track["track"]["artists"][0]["id"])["genres"]
+            except spotipy.SpotifyException:
+                pass
+
+
+def bench_playlist_calls(n_tracks=2000, n_artists=300):
+    """Compare API calls per track of per-track and batched playlist ingestion
+    against the local mock of the Web API."""
+    results = {}
+    with MockSpotifyAPI(n_tracks=n_tracks, n_artists=n_artists) as api:
+        sp = api.client()
+        for name, func in [
+            ("per_track", _per_track_enrichment),
+            ("batched", analyze_playlist),
+        ]:
+            api.reset()
+            start = time.perf_counter()
+            func(api.playlist_id, sp)
+            elapsed = time.perf_counter() - start
+            results[name] = {
+                "calls": api.total_calls,
+                "calls_per_track": api.total_calls / n_tracks,
+                "seconds": elapsed,
+                "endpoints": dict(api.calls),
+            }
+
+    print(f"Playlist of {n_tracks} tracks by {n_artists} artists")
+    for name, result in results.items():
+        print(
+            f"{name:>10}: {result['calls']:6d} calls, "
+            f"{result['calls_per_track']:.3f} calls/track, {result['seconds']:.2f} s"
+        )
+    return results
+
+
+def bench_playlist_cache(n_tracks=2000, n_artists=300, overlap=0.8):
+    """API calls of a cold and a warm ingest of two overlapping playlists that
+    share the on-disk cache."""
+    cache = SpotifyCache(":memory:")
+    results = {}
+    with MockSpotifyAPI(n_tracks=n_tracks, n_artists=n_artists) as api:
+        sp = api.client()
+        for name, tracks in [
+            ("cold", n_tracks),
+            ("warm", n_tracks),
+            ("overlapping", int(n_tracks / overlap)),
+        ]:
+            api.n_tracks = tracks
+            api.reset()
+            analyze_playlist(api.playlist_id, sp, cache=cache)
+            results[name] = {"calls": api.total_calls, "endpoints": dict(api.calls)}
+    results["cache"] = cache.stats()
+
+    for name in ["cold", "warm", "overlapping"]:
+        print(
+            f"{name:>12}: {results[name]['calls']:5d} calls {results[name]['endpoints']}"
+        )
+    print(f"Cache: {results['cache']}")
+    return results
+
+
+def bench_playlist_pages(n_tracks=3000, delay=0.1, rate_limit_every=25):
+    """Wall time of sequential and concurrent page fetching against a stand-in
+    server that delays every answer and injects 429s."""
+    results = {}
+    with MockSpotifyAPI(
+        n_tracks=n_tracks, delay=delay, rate_limit_every=rate_limit_every
+    ) as api:
+        sp = api.client()
+        for max_workers in [1, 8]:
+            api.reset()
+            start = time.perf_counter()
+            pages = fetch_playlist_pages(
+                api.playlist_id,
+                n_tracks,
+                sp,
+                bucket=TokenBucket(rate=50, capacity=10),
+                max_workers=max_workers,
+            )
+            elapsed = time.perf_counter() - start
+            track_ids = [item["track"]["id"] for page in pages for item in page]
+            results[max_workers] = {
+                "seconds": elapsed,
+                "pages": len(pages),
+                "rate_limited": api.rate_limited,
+                "in_order": track_ids == sorted(track_ids),
+            }
+
+    print(
+        f"{n_tracks} tracks, {delay} s latency, every {rate_limit_every}th call is a 429"
+    )
+    for max_workers, result in results.items():
+        print(f"{max_workers} workers: {result}")
+    return results
+
+
+def bench_bulk_ingest(n_playlists=12, n_tracks=1000, overlap=0.5):
+    """API calls of separate runs per playlist compared to one bulk run over
+    overlapping playlists."""
+    step = int(n_tracks * (1 - overlap))
+    playlists = {f"pl{i:03d}": (i * step, n_tracks) for i in range(n_playlists)}
+    results = {}
+    with MockSpotifyAPI(playlists=playlists) as api:
+        sp = api.client()
+
+        api.reset()
+        start = time.perf_counter()
+        for playlist_id in playlists:
+            analyze_playlist(playlist_id, sp, bucket=TokenBucket(rate=1000))
+        results["separate"] = {
+            "calls": api.total_calls,
+            "seconds": time.perf_counter() - start,
+        }
+
+        api.reset()
+        with tempfile.TemporaryDirectory() as directory:
+            report = ingest_playlists(
+                list(playlists),
+                sp,
+                bucket=TokenBucket(rate=1000),
+                directory=directory,
+            )
+        results["bulk"] = {"calls": api.total_calls, "seconds": report["seconds"]}
+
+    print(f"{n_playlists} playlists of {n_tracks} tracks, {overlap:.0%} overlap")
+    for name, result in results.items():
+        print(f"{name:>10}: {result['calls']:5d} calls, {result['seconds']:.2f} s")
+    return results
+
+
+def make_streaming_history(n_rows=1_000_000, n_tracks=30_000, n_artists=8_000, seed=0):
+    """Synthetic streaming history with the columns of the real export."""
+    rng = np.random.default_rng(seed)
+    # Few tracks are played a lot, most rarely
+    track = np.minimum(rng.zipf(1.3, n_rows), n_tracks) - 1
+    track = rng.permutation(n_tracks)[track]
+    start = pd.Timestamp("2012-01-01", tz="UTC").value
+    end = pd.Timestamp("2023-06-01", tz="UTC").value
+    end_time = np.sort(rng.integers(start, end, n_rows))
+    track_names = np.array(
+        [
+            f"Track {i} (feat. Artist {i % 97})" if i % 5 == 0 else f"Track {i}"
+            for i in range(n_tracks)
+        ]
+    )
+    reasons = np.array(["trackdone", "fwdbtn", "clickrow", "backbtn", "playbtn"])
+    return pd.DataFrame(
+        {
+            "endTime": pd.to_datetime(end_time, utc=True),
+            "ms_played": rng.integers(0, 400_000, n_rows),
+            "trackName": track_names[track],
+            "artistName": np.char.add("Artist ", (track % n_artists).astype(str)),
+            "reason_start": reasons[rng.integers(0, 5, n_rows)],
+            "reason_end": reasons[rng.integers(0, 5, n_rows)],
+            "shuffle": rng.random(n_rows) < 0.5,
+            "skipped": (rng.random(n_rows) < 0.2).astype(float),
+        }
+    )
+
+
+def _cold_load(code):
+    """Run loading code in a fresh interpreter and measure time and peak memory."""
+    script = f"""
+import json, re, resource, time
+import pandas as pd
+start = time.perf_counter()
+{code}
+seconds = time.perf_counter() - start
+# ru_maxrss survives exec on linux and would include the parent, VmHWM does not
+status = open("/proc/self/status").read()
+print(json.dumps({{
+    "seconds": seconds,
+    "peak_rss_mb": int(re.search(r"VmHWM:\\s+(\\d+)", status).group(1)) / 1024,
+    # Largest worker process, if the code started any
+    "worker_peak_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    "frame_mb": df.memory_usage(deep=True).sum() / 1e6,
+    # Memory of the process itself, without file pages shared with others
+    "anonymous_mb": int(
+        re.search(r"Anonymous:\s+(\d+)", open("/proc/self/smaps_rollup").read()).group(1)
+    ) / 1024,
+}}))
+"""
+    cwd = Path(__file__).resolve().parents[1]
+    result = subprocess.run(
+        [sys.executable, "-c", script],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=cwd,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def bench_streaming_load(n_rows=2_000_000):
+    """Cold load time and memory of the streaming history from csv and from the
+    parquet store."""
+    history = make_streaming_history(n_rows)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        csv_path = Path(directory) / "total_streaming_data.csv"
+        store_path = Path(directory) / "streaming_store"
+        history.to_csv(csv_path)
+        write_streaming_store(history, store_path, export=None)
+
+        dtypes = {
+            "ms_played": "int",
+            "trackName": "str",
+            "artistName": "str",
+            "reason_start": "str",
+            "reason_end": "str",
+            "shuffle": "bool",
+            "skipped": "float",
+        }
+        results["csv"] = _cold_load(
+            f"df = pd.read_csv({str(csv_path)!r}, parse_dates=['endTime'], dtype={dtypes!r})"
+        )
+        results["parquet"] = _cold_load(
+            "from streaming_data import read_streaming_store\n"
+            f"df = read_streaming_store({str(store_path)!r})"
+        )
+
+    print(f"Cold load of {n_rows} plays")
+    for name, result in results.items():
+        print(
+            f"{name:>8}: {result['seconds']:6.2f} s, peak rss {result['peak_rss_mb']:7.1f} MB, "
+            f"frame {result['frame_mb']:7.1f} MB"
+        )
+    return results
+
+
+def bench_streaming_mmap(n_rows=2_000_000):
+    """Cold load time and private memory of the streaming history from the
+    parquet store and from the memory-mapped column store."""
+    history = make_streaming_history(n_rows)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        store_path = Path(directory) / "streaming_store"
+        columns_path = Path(directory) / "columns"
+        write_streaming_store(history, store_path, export=None)
+        write_column_store(read_streaming_store(store_path), columns_path)
+
+        # Every column is read, as by the plots
+        touch = "df.groupby(['trackName', 'artistName'], observed=True).size()\n"
+        touch += "df['endTime'].max(), df['ms_played'].sum()\n"
+        results["parquet"] = _cold_load(
+            "from streaming_data import read_streaming_store\n"
+            f"df = read_streaming_store({str(store_path)!r})\n" + touch
+        )
+        results["mmap"] = _cold_load(
+            "from util.column_store import read_column_store\n"
+            f"df = read_column_store({str(columns_path)!r})\n" + touch
+        )
+
+    print(f"Cold load of {n_rows} plays")
+    for name, result in results.items():
+        print(
+            f"{name:>8}: {result['seconds']:6.2f} s, "
+            f"private memory {result['anonymous_mb']:7.1f} MB, "
+            f"frame {result['frame_mb']:7.1f} MB"
+        )
+    return results
+
+
+def _write_endsong_export(history, directory, n_files):
+    """Write a streaming history as the json files of an extended export."""
+    records = pd.DataFrame(
+        {
+            "ts": history["endTime"].dt.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "username": "user",
+            "platform": "Android OS",
+            "ms_played": history["ms_played"],
+            "conn_country": "DK",
+            "master_metadata_track_name": history["trackName"],
+            "master_metadata_album_artist_name": history["artistName"],
+            "master_metadata_album_album_name": "Album",
+            "spotify_track_uri": "spotify:track:0000000000000000000000",
+            "reason_start": history["reason_start"],
+            "reason_end": history["reason_end"],
+            "shuffle": history["shuffle"],
+            "skipped": history["skipped"].astype(bool),
+            "offline": False,
+        }
+    )
+    bounds = np.linspace(0, len(records), n_files + 1).astype(int)
+    for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        records.iloc[start:end].to_json(
+            Path(directory) / f"endsong_{i}.json", orient="records"
+        )
+
+
+def bench_streaming_ingest(n_rows=1_000_000, n_files=8):
+    """Conversion time and peak memory of the endsong export to the store, with
+    the whole export in one frame and with the streaming ingest."""
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        export_dir = Path(directory) / "MyData"
+        export_dir.mkdir()
+        _write_endsong_export(make_streaming_history(n_rows), export_dir, n_files)
+        store = Path(directory) / "streaming_store"
+
+        results["read_json"] = _cold_load(
+            "from pathlib import Path\n"
+            "from streaming_data import write_streaming_store\n"
+            f"files = Path({str(export_dir)!r}).glob('*endsong*.json')\n"
+            "df = pd.concat(pd.read_json(f, convert_dates=['ts']) for f in files)\n"
+            "df = df.rename(columns={'ts': 'endTime', "
+            "'master_metadata_track_name': 'trackName', "
+            "'master_metadata_album_artist_name': 'artistName'})\n"
+            f"write_streaming_store(df, Path({str(store)!r}), export=None)"
+        )
+        for max_workers in [1, 4]:
+            results[f"streaming_{max_workers}"] = _cold_load(
+                "from pathlib import Path\n"
+                "from streaming_data import convert_stream_data\n"
+                f"n_rows = convert_stream_data({str(export_dir)!r}, "
+                f"max_workers={max_workers}, path=Path({str(store)!r}), export=None)\n"
+                "df = pd.DataFrame({'n_rows': [n_rows]})"
+            )
+
+    print(f"Conversion of {n_rows} plays in {n_files} endsong files")
+    for name, result in results.items():
+        print(
+            f"{name:>12}: {result['seconds']:6.2f} s, peak rss {result['peak_rss_mb']:7.1f} MB, "
+            f"worker peak rss {result['worker_peak_rss_mb']:7.1f} MB"
+        )
+    return results
+
+
+def bench_streaming_update(store_rows=(500_000, 2_000_000), delta_rows=20_000):
+    """Time of merging the same export update into stores of growing size."""
+    results = {}
+    for n_rows in store_rows:
+        history = make_streaming_history(n_rows + delta_rows)
+        # The first plays of the update are already in the store
+        update = history.iloc[n_rows - delta_rows // 2 :]
+        with tempfile.TemporaryDirectory() as directory:
+            store = Path(directory) / "streaming_store"
+            write_streaming_store(history.iloc[:n_rows], store, export=None)
+            start = time.perf_counter()
+            added = merge_streaming_data(update, store)
+            seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            rerun = merge_streaming_data(update, store)
+            results[n_rows] = {
+                "added": added,
+                "seconds": seconds,
+                "rerun_added": rerun,
+                "rerun_seconds": time.perf_counter() - start,
+            }
+
+    print(f"Merge of {len(update)} plays, {delta_rows // 2} already in the store")
+    for n_rows, result in results.items():
+        print(f"{n_rows:>9} plays in store: {result}")
+    return results
+
+
+def _string_top_plays(df, mask, n):
+    """Reference implementation of the top plays of the barplot, grouping on the
+    track and artist name strings."""
+    track_name = df["trackName"].str.split("(", expand=True)[0]
+    count = (
+        df.assign(trackName=track_name)
+        .loc[mask]
+        .groupby(["trackName", "artistName"], as_index=False)
+        .size()
+    )
+    return count.sort_values(
+        ["size", "trackName", "artistName"], ascending=[False, True, True]
+    )[0:n].reset_index(drop=True)
+
+
+def bench_streaming_groupby(n_rows=2_000_000, n=40):
+    """Memory of the streaming history with string and with integer coded names,
+    and time of the top plays of the barplot on each."""
+    history = make_streaming_history(n_rows)
+    strings = history.astype({column: object for column in ["trackName", "artistName"]})
+    coded = _compact_types(history)
+    mask = strings["endTime"] > pd.Timestamp("2014-01-01", tz="UTC")
+
+    results = {}
+    start = time.perf_counter()
+    expected = _string_top_plays(strings, mask, n)
+    results["strings"] = {
+        "frame_mb": float(strings.memory_usage(deep=True).sum() / 1e6),
+        "seconds": time.perf_counter() - start,
+    }
+    start = time.perf_counter()
+    keys, titles, artists = track_artist_keys(coded)
+    top = top_plays(keys[mask.to_numpy()], titles, artists, n)
+    results["codes"] = {
+        "frame_mb": float(coded.memory_usage(deep=True).sum() / 1e6),
+        "seconds": time.perf_counter() - start,
+        "equal": top.astype(expected.dtypes).equals(expected),
+    }
+
+    print(f"Top {n} plays of {n_rows} plays")
+    for name, result in results.items():
+        print(f"{name:>8}: {result}")
+    return results
+
+
+def bench_streaming_rollup(n_rows=2_000_000, n_queries=20):
+    """Time of the top plays of the barplot for random date ranges, from the
+    plays and from the daily rollup."""
+    history = _compact_types(make_streaming_history(n_rows))
+    rng = np.random.default_rng(0)
+    days = pd.date_range(history["endTime"].min(), history["endTime"].max(), freq="D")
+    ranges = [np.sort(rng.choice(days, 2, replace=False)) for _ in range(n_queries)]
+    ranges = [(pd.Timestamp(start), pd.Timestamp(end)) for start, end in ranges]
+
+    results = {}
+    start = time.perf_counter()
+    expected = []
+    day = history["endTime"].dt.floor("D")
+    for first, last in ranges:
+        mask = ((day >= first.floor("D")) & (day <= last.floor("D"))).to_numpy()
+        keys, titles, artists = track_artist_keys(history)
+        expected.append(top_plays(keys[mask], titles, artists, 40))
+    results["plays"] = {"seconds_per_query": (time.perf_counter() - start) / n_queries}
+
+    start = time.perf_counter()
+    rollup = DailyRollup.from_plays(history)
+    build = time.perf_counter() - start
+    start = time.perf_counter()
+    equal = True
+    for (first, last), reference in zip(ranges, expected):
+        totals = rollup.totals(first, last)
+        keys, titles, artists = rollup_keys(rollup)
+        top = top_plays(keys, titles, artists, 40, totals["plays"].to_numpy())
+        equal &= top.equals(reference)
+    results["rollup"] = {
+        "seconds_per_query": (time.perf_counter() - start) / n_queries,
+        "build_seconds": build,
+        "rows": len(rollup),
+        "equal": bool(equal),
+    }
+
+    print(f"Top 40 plays of {n_queries} date ranges of {n_rows} plays")
+    for name, result in results.items():
+        print(f"{name:>8}: {result}")
+    return results
+
+
+def bench_streaming_time_index(n_rows=2_000_000, n_queries=50):
+    """Time of selecting random time ranges from the sorted streaming history
+    with boolean masks and with the time index."""
+    history = sort_by_time(_compact_types(make_streaming_history(n_rows)))
+    rng = np.random.default_rng(0)
+    rows = [np.sort(rng.choice(n_rows, 2, replace=False)) for _ in range(n_queries)]
+    ranges = [tuple(history["endTime"].iloc[row]) for row in rows]
+
+    results = {}
+    start = time.perf_counter()
+    expected = []
+    for first, last in ranges:
+        mask = (history["endTime"] > first) & (history["endTime"] <= last)
+        expected.append(len(history[mask]))
+    results["mask"] = {
+        "seconds_per_query": (time.perf_counter() - start) / n_queries,
+    }
+
+    start = time.perf_counter()
+    index = TimeIndex(history["endTime"])
+    found = [len(index.slice(history, first, last)) for first, last in ranges]
+    results["index"] = {
+        "seconds_per_query": (time.perf_counter() - start) / n_queries,
+        "equal": found == expected,
+    }
+
+    print(f"{n_queries} time ranges of {n_rows} plays")
+    for name, result in results.items():
+        print(f"{name:>8}: {result}")
+    return results
+
+
+def bench_query_backends(n_rows=2_000_000, n_queries=10):
+    """Time of the queries of the streaming plots with pandas on the history in
+    memory and with DuckDB over the parquet store, and whether they agree."""
+    history = make_streaming_history(n_rows)
+    rng = np.random.default_rng(0)
+    days = pd.date_range(history["endTime"].min(), history["endTime"].max(), freq="D")
+    ranges = [np.sort(rng.choice(days, 2, replace=False)) for _ in range(n_queries)]
+    ranges = [(pd.Timestamp(start), pd.Timestamp(end)) for start, end in ranges]
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        store = Path(directory) / "streaming_store"
+        write_streaming_store(history, store, export=None)
+        del history
+
+        start = time.perf_counter()
+        df = read_streaming_store(store)
+        backends = {
+            "pandas": PandasQueries(df, read_daily_rollup(store)),
+            "duckdb": DuckDBQueries(store),
+        }
+        load = {"pandas": time.perf_counter() - start, "duckdb": 0.0}
+
+        for name, queries in backends.items():
+            result = {"load_seconds": load[name]}
+            start = time.perf_counter()
+            for first, last in ranges:
+                queries.top_tracks(40, first, last)
+            result["top_tracks"] = (time.perf_counter() - start) / n_queries
+            start = time.perf_counter()
+            for first, last in ranges:
+                queries.weekday_top_tracks(5, first, last, months=(12, 1, 2))
+            result["weekday_top_tracks"] = (time.perf_counter() - start) / n_queries
+            start = time.perf_counter()
+            queries.yearly_top_tracks(100)
+            result["yearly_top_tracks"] = time.perf_counter() - start
+            results[name] = result
+        results["equal"] = check_backends(
+            backends["pandas"], backends["duckdb"], ranges + [(None, None)]
+        )
+
+    print(f"Seconds per query of {n_rows} plays")
+    for name, result in results.items():
+        print(f"{name:>8}: {result}")
+    return results
+
+
+def _weekday_top_plays(df, first, last, months, n):
+    """Reference implementation of the weekday top plays, filtering the plays
+    once per weekday and sorting all counts of each."""
+    titles = df["trackName"].astype(str).str.split("(").str[0]
+    df = df.assign(trackName=titles, artistName=df["artistName"].astype(str))
+    first, last = first.floor("D"), last.floor("D") + pd.Timedelta(days=1)
+    mask = (df["endTime"] >= first) & (df["endTime"] < last)
+    df = df[mask]
+    df = df[
+        (df.endTime.dt.month == months[0])
+        | (df.endTime.dt.month == months[1])
+        | (df.endTime.dt.month == months[2])
+    ]
+    tops = []
+    for i in range(7):
+        day = df[df["endTime"].dt.dayofweek == i]
+        count = day.groupby(["trackName", "artistName"], as_index=False).size()
+        count = count.sort_values(
+            ["size", "trackName", "artistName"], ascending=[False, True, True]
+        )
+        tops.append(count[0:n].assign(weekday=i))
+    return pd.concat(tops, ignore_index=True)[WEEKDAY_COLUMNS]
+
+
+def bench_weekday_top(n_rows=4_000_000, n_queries=5, n=5):
+    """Time of the weekday top plays of a season for random date ranges, with
+    a filter per weekday and with one aggregation over the daily rollup."""
+    history = _compact_types(make_streaming_history(n_rows))
+    rng = np.random.default_rng(0)
+    days = pd.date_range(history["endTime"].min(), history["endTime"].max(), freq="D")
+    ranges = [np.sort(rng.choice(days, 2, replace=False)) for _ in range(n_queries)]
+    ranges = [(pd.Timestamp(start), pd.Timestamp(end)) for start, end in ranges]
+    winter = (12, 1, 2)
+
+    results = {}
+    start = time.perf_counter()
+    expected = [_weekday_top_plays(history, *days, winter, n) for days in ranges]
+    results["filters"] = {
+        "seconds_per_query": (time.perf_counter() - start) / n_queries
+    }
+
+    start = time.perf_counter()
+    queries = PandasQueries(history, DailyRollup.from_plays(history))
+    build = time.perf_counter() - start
+    start = time.perf_counter()
+    found = [queries.weekday_top_tracks(n, *days, winter) for days in ranges]
+    results["single_pass"] = {
+        "seconds_per_query": (time.perf_counter() - start) / n_queries,
+        "rollup_seconds": build,
+        "equal": all(
+            top.astype(str).equals(reference.astype(str))
+            for top, reference in zip(found, expected)
+        ),
+    }
+
+    print(f"Top {n} plays per weekday of winter in {n_queries} date ranges")
+    print(f"of {n_rows} plays")
+    for name, result in results.items():
+        print(f"{name:>12}: {result}")
+    return results
+
+
+def _apply_yearly_top(df, n):
+    """Reference implementation of the yearly top plays, with nlargest applied
+    to every year."""
+    df = (
+        df.groupby([df["endTime"].dt.year, "trackName", "artistName"], observed=True)
+        .agg(ms_played=("ms_played", "sum"), count=("ms_played", "size"))
+        .reset_index()
+        .astype({"ms_played": "int64"})
+    )
+    df = df.sort_values(
+        ["trackName", "artistName"], key=lambda column: column.astype(str)
+    )
+    return (
+        df.groupby(["endTime"])[df.columns]
+        .apply(lambda x: x.nlargest(n, ["count"]))
+        .reset_index(drop=True)
+    )
+
+
+def bench_yearly_top(n_rows=4_000_000, n=100):
+    """Time of the yearly top plays of the animation with nlargest applied to
+    every year and with one sort, and of a repeated query."""
+    history = _compact_types(make_streaming_history(n_rows))
+    results = {}
+    start = time.perf_counter()
+    expected = _apply_yearly_top(history, n)
+    results["apply"] = {"seconds": time.perf_counter() - start}
+
+    queries = PandasQueries(history)
+    start = time.perf_counter()
+    top = queries.yearly_top_tracks(n)
+    seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    queries.yearly_top_tracks(n)
+    results["sort"] = {
+        "seconds": seconds,
+        "repeat_seconds": time.perf_counter() - start,
+        "equal": top.equals(expected),
+    }
+
+    print(f"Top {n} plays per year of {n_rows} plays")
+    for name, result in results.items():
+        print(f"{name:>8}: {result}")
+    return results
+
+
+def bench_page_rerun(n_rows=2_000_000, n_reruns=3):
+    """Peak memory of reruns of the all-time streaming page, with and without a
+    copy of the cached streaming history on every rerun."""
+    history = make_streaming_history(n_rows)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        columns_path = Path(directory) / "columns"
+        write_column_store(_compact_types(history), columns_path)
+        del history
+
+        for name, copy in [("copy", "cached.copy()"), ("shared", "cached")]:
+            results[name] = _cold_load(
+                "from plotting import get_streaming_barplot, "
+                "get_temporal_distribution\n"
+                "from util.column_store import read_column_store\n"
+                "from util.query import PandasQueries\n"
+                f"cached = read_column_store({str(columns_path)!r})\n"
+                "queries = PandasQueries(cached)\n"
+                "days = (cached['endTime'].min(), cached['endTime'].max())\n"
+                f"for _ in range({n_reruns}):\n"
+                f"    df = {copy}\n"
+                "    get_streaming_barplot(df, 10, days, queries=queries)\n"
+                "    get_temporal_distribution(df, days, 'Winter', queries=queries)\n"
+            )
+
+    print(f"{n_reruns} reruns of the page with {n_rows} plays")
+    for name, result in results.items():
+        print(
+            f"{name:>8}: {result['seconds']:6.2f} s, "
+            f"peak rss {result['peak_rss_mb']:7.1f} MB, "
+            f"private memory {result['anonymous_mb']:7.1f} MB"
+        )
+    return results
+
+
+def bench_figure_cache(n_rows=1_000_000, n_reruns=20):
+    """Time of reruns of the all-time streaming page that change one slider,
+    building every figure and with the figure cache."""
+    history = _compact_types(make_streaming_history(n_rows))
+    queries = PandasQueries(history, DailyRollup.from_plays(history))
+    days = pd.date_range(history["endTime"].min(), history["endTime"].max(), freq="D")
+    rng = np.random.default_rng(0)
+    # Each rerun moves one end date slider, some back to an earlier position
+    ends = rng.choice(days[-10:], n_reruns)
+    full = (days[0], days[-1])
+    inputs = {"df": history, "queries": queries}
+    animation_inputs = {"streaming_df": history, "queries": queries}
+
+    def build(function, inputs, **params):
+        return function(**inputs, **params)
+
+    def rerun(figure, end):
+        return [
+            figure(get_streaming_barplot, inputs, range=10, time_range=(days[0], end)),
+            figure(get_temporal_distribution, inputs, time_range=full, season=None),
+            figure(get_most_played_animation, animation_inputs),
+        ]
+
+    results = {}
+    start = time.perf_counter()
+    for end in ends:
+        built = rerun(build, end)
+    results["build"] = {"seconds_per_rerun": (time.perf_counter() - start) / n_reruns}
+
+    cache = FigureCache()
+    start = time.perf_counter()
+    for end in ends:
+        cached = rerun(functools.partial(cache.figure, "bench"), end)
+    results["cache"] = {
+        "seconds_per_rerun": (time.perf_counter() - start) / n_reruns,
+        "equal": [json.loads(a.to_json()) for a in built]
+        == [json.loads(b.to_json()) for b in cached],
+        "bytes": cache.bytes,
+        **cache.stats,
+    }
+
+    print(f"{n_reruns} reruns of the page with {n_rows} plays")
+    for name, result in results.items():
+        print(f"{name:>8}: {result}")
+    return results
+
+
+BENCHMARKS = {
+    "playlist_calls": bench_playlist_calls,
+    "playlist_cache": bench_playlist_cache,
+    "playlist_pages": bench_playlist_pages,
+    "bulk_ingest": bench_bulk_ingest,
+    "streaming_load": bench_streaming_load,
+    "streaming_mmap": bench_streaming_mmap,
+    "streaming_ingest": bench_streaming_ingest,
+    "streaming_update": bench_streaming_update,
+    "streaming_groupby": bench_streaming_groupby,
+    "streaming_rollup": bench_streaming_rollup,
+    "streaming_time_index": bench_streaming_time_index,
+    "query_backends": bench_query_backends,
+    "weekday_top": bench_weekday_top,
+    "yearly_top": bench_yearly_top,
+    "page_rerun": bench_page_rerun,
+    "figure_cache": bench_figure_cache,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
@@ -0,0 +1,201 @@
+"""On-disk cache for Spotify API lookups.
+
+Entries are stored in a small SQLite database as JSON, grouped in namespaces
+such as artist genres and audio features. Each entry expires after a time to
+live and the least recently used entries are evicted when the cache grows past
+its maximum size.
+"""
+import json
+import sqlite3
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+import pandas as pd
+
+# Namespaces used by spotify.py
+ARTIST_GENRES_NS = "artist_genres"
+AUDIO_FEATURES_NS = "audio_features"
+
+# Default location and limits of the cache
+CACHE_PATH = Path("data/spotify_cache.sqlite")
+DEFAULT_TTL = 30 * 24 * 3600
+DEFAULT_MAX_ENTRIES = 200_000
+
+# SQLite limits the number of variables in a single statement
+_MAX_VARIABLES = 900
+
+
+class SpotifyCache:
+    """Key-value cache of API lookups with time to live and size bound.
+
+    Args:
+        path (str or Path): SQLite file to store the cache in. ":memory:" keeps it in memory.
+        ttl (float): Seconds an entry stays valid.
+        max_entries (int): Maximum number of entries before the least recently used are evicted.
+    """
+
+    def __init__(
+        self, path=CACHE_PATH, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        # Hit and miss counts per namespace
+        self.hits = Counter()
+        self.misses = Counter()
+
+        if path != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT,
+                expires_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at)"
+        )
+        self._conn.commit()
+
+    def get_many(self, namespace, keys):
+        """Look up keys in a namespace.
+
+        Args:
+            namespace (str): Namespace of the keys.
+            keys (iterable of str): Keys to look up.
+
+        Returns:
+            found (dict): Cached values of the keys that were present and not expired.
+        """
+        keys = list(dict.fromkeys(keys))
+        now = time.time()
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), _MAX_VARIABLES):
+                batch = keys[start : start + _MAX_VARIABLES]
+                rows = self._conn.execute(
+                    f"SELECT key, value FROM entries WHERE namespace = ? "
+                    f"AND expires_at > ? AND key IN ({','.join('?' * len(batch))})",
+                    [namespace, now, *batch],
+                ).fetchall()
+                found.update((key, json.loads(value)) for key, value in rows)
+            if found:
+                self._conn.executemany(
+                    "UPDATE entries SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                    [(now, namespace, key) for key in found],
+                )
+                self._conn.commit()
+            self.hits[namespace] += len(found)
+            self.misses[namespace] += len(keys) - len(found)
+        return found
+
+    def set_many(self, namespace, items, ttl=None):
+        """Store key-value pairs in a namespace.
+
+        Args:
+            namespace (str): Namespace of the keys.
+            items (dict): Values to store. Values must be JSON serializable.
+            ttl (float): Seconds the entries stay valid. Defaults to the cache ttl.
+        """
+        if not items:
+            return
+        now = time.time()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                [
+                    (namespace, key, json.dumps(value), expires_at, now)
+                    for key, value in items.items()
+                ],
+            )
+            self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now):
+        """Remove expired entries and the least recently used entries above
+        max_entries."""
+        self._conn.execute("DELETE FROM entries WHERE expires_at <= ?", (now,))
+        (size,) = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()
+        if size > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM entries WHERE rowid IN "
+                "(SELECT rowid FROM entries ORDER BY accessed_at LIMIT ?)",
+                (size - self.max_entries,),
+            )
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def stats(self):
+        """Hit and miss counts per namespace."""
+        return {
+            namespace: {
+                "hits": self.hits[namespace],
+                "misses": self.misses[namespace],
+            }
+            for namespace in sorted(set(self.hits) | set(self.misses))
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def seed_from_playlists(cache, paths=None):
+    """Fill the cache with lookups already stored in downloaded playlists.
+
+    Audio features are taken from every playlist csv. Artist genres are taken
+    from playlists downloaded with an artist_id column.
+
+    Args:
+        cache (SpotifyCache): Cache to fill.
+        paths (iterable of Path): Playlist csv files. Defaults to data/playlists/*.csv.
+
+    Returns:
+        seeded (dict): Number of entries added per namespace.
+    """
+    # Imported here to avoid circular import, spotify.py uses this module
+    from spotify import AUDIO_FEATURES
+
+    if paths is None:
+        paths = Path("data/playlists").glob("*.csv")
+    frames = [pd.read_csv(path) for path in paths]
+    if not frames:
+        return {}
+    df = pd.concat(frames, ignore_index=True)
+
+    # Tracks without audio features are stored with zeros, skip those
+    features = df.dropna(subset=["track_id"]).drop_duplicates("track_id")
+    features = features[(features[AUDIO_FEATURES] != 0).any(axis=1)]
+    # Round trip through JSON to convert numpy types to something JSON can store
+    audio_features = json.loads(
+        features.set_index("track_id")[AUDIO_FEATURES].to_json(orient="index")
+    )
+    cache.set_many(AUDIO_FEATURES_NS, audio_features)
+
+    artist_genres = {}
+    if "artist_id" in df.columns:
+        artists = df.dropna(subset=["artist_id"]).drop_duplicates("artist_id")
+        artist_genres = {
+            artist_id: [] if genre == "unknown" else genre.split("/")
+            for artist_id, genre in zip(artists["artist_id"], artists["genre"])
+        }
+        cache.set_many(ARTIST_GENRES_NS, artist_genres)
+
+    return {
+        AUDIO_FEATURES_NS: len(audio_features),
+        ARTIST_GENRES_NS: len(artist_genres),
+    }
@@ -0,0 +1,129 @@
+"""Shared Spotify API clients.
+
+get_spotify_client hands out one spotipy client per scope and settings for the
+lifetime of the process, so the download page and the command line share
+keep-alive connections and the access token instead of setting them up again
+for every download.
+"""
+import threading
+import time
+
+import requests
+import spotipy
+import streamlit as st
+import urllib3
+from spotipy.cache_handler import CacheFileHandler
+from spotipy.oauth2 import SpotifyOAuth
+
+# Number of keep-alive connections kept open to each host
+POOL_SIZE = 16
+
+# Seconds before expiry the access token is refreshed
+REFRESH_MARGIN = 300
+
+DEFAULT_TIMEOUT = 10
+DEFAULT_RETRIES = 3
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class _MemoryCacheFileHandler(CacheFileHandler):
+    """Token cache kept in memory and written through to the cache file.
+
+    The default handler reads the cache file before every API request.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._token_info = None
+
+    def get_cached_token(self):
+        if self._token_info is None:
+            self._token_info = super().get_cached_token()
+        return self._token_info
+
+    def save_token_to_cache(self, token_info):
+        self._token_info = token_info
+        super().save_token_to_cache(token_info)
+
+
+class _ProactiveSpotifyOAuth(SpotifyOAuth):
+    """SpotifyOAuth that refreshes the token well before it expires.
+
+    Only one thread refreshes the token, the others wait for the new one.
+    """
+
+    refresh_margin = REFRESH_MARGIN
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._token_lock = threading.Lock()
+
+    def is_token_expired(self, token_info):
+        return token_info["expires_at"] - time.time() < self.refresh_margin
+
+    def get_access_token(self, *args, **kwargs):
+        with self._token_lock:
+            return super().get_access_token(*args, **kwargs)
+
+
+def _build_session(retries):
+    """Session with a keep-alive connection pool that retries connection errors.
+
+    Responses are not retried here. 429 and server errors are retried by
+    util.ratelimit.call, which backs off with the token bucket shared by all
+    threads and records every attempt in util.metrics.METRICS.
+    """
+    retry = urllib3.Retry(
+        total=retries,
+        connect=retries,
+        read=False,
+        status=0,
+        allowed_methods=frozenset(["GET", "POST", "PUT", "DELETE"]),
+        backoff_factor=0.3,
+        raise_on_status=False,
+    )
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=4, pool_maxsize=POOL_SIZE, max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_spotify_client(scope, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES):
+    """Get the shared spotipy client for a scope.
+
+    The client is created on first use with the app credentials from the
+    streamlit secrets, and reused afterwards.
+
+    Args:
+        scope (str): Authorization scope, eg. "playlist-read-private".
+        timeout (float): Seconds to wait for an answer from the API.
+        retries (int): Number of retries on connection errors. Server errors
+            are retried by util.ratelimit.call.
+
+    Returns:
+        sp (spotipy.Spotify): Authenticated client.
+    """
+    key = (scope, timeout, retries)
+    with _clients_lock:
+        if key not in _clients:
+            session = _build_session(retries)
+            auth_manager = _ProactiveSpotifyOAuth(
+                client_id=st.secrets["CLIENT_ID"],
+                client_secret=st.secrets["CLIENT_SECRET"],
+                redirect_uri=st.secrets["REDIRECT_URI"],
+                scope=scope,
+                requests_session=session,
+                requests_timeout=timeout,
+                cache_handler=_MemoryCacheFileHandler(),
+            )
+            _clients[key] = spotipy.Spotify(
+                auth_manager=auth_manager,
+                requests_session=session,
+                requests_timeout=timeout,
+            )
+        return _clients[key]
@@ -0,0 +1,114 @@
+"""Memory-mapped column store of a frame.
+
+Every column is one .npy file, read back with np.load(mmap_mode="r"). The
+frame is then backed by the page cache instead of the memory of the process,
+so all processes on a host that read the same store share one copy of it, and
+reading takes no parsing. Categorical columns are stored as their integer
+codes with the categories in the metadata, and timestamps as int64 ns since
+the epoch.
+
+The arrays are read-only, so the frames must not be modified in place.
+"""
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+METADATA_NAME = "columns.json"
+
+
+def _column_array(column):
+    """Array of a column as stored, and its metadata."""
+    dtype = column.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        meta = {"dtype": "category", "categories": dtype.categories.tolist()}
+        return column.cat.codes.to_numpy(), meta
+    if isinstance(dtype, pd.DatetimeTZDtype):
+        return column.array.asi8, {"dtype": str(dtype)}
+    return column.to_numpy(), {"dtype": str(dtype)}
+
+
+def _column(array, meta):
+    """Column of a stored array and its metadata, without copying the array."""
+    if meta["dtype"] == "category":
+        return pd.Categorical.from_codes(
+            array, categories=meta["categories"], validate=False
+        )
+    if meta["dtype"].startswith("datetime64"):
+        dtype = pd.api.types.pandas_dtype(meta["dtype"])
+        return pd.array(array.view("M8[ns]"), copy=False).view(dtype)
+    return array
+
+
+def write_column_store(df, directory, version=None):
+    """Write a frame as a column store.
+
+    The store is written to a temporary folder that is renamed into place, so
+    readers never see a partial store. If another process wrote the same
+    store first, its store is kept.
+
+    Args:
+        df (DataFrame): Data with numeric, bool, categorical or datetime
+            columns.
+        directory (str or Path): Folder of the store.
+        version (str): Version of the data, returned by column_store_version.
+    """
+    directory = Path(directory)
+    directory.parent.mkdir(parents=True, exist_ok=True)
+    tmp = directory.with_name(f".{directory.name}.{os.getpid()}")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir()
+    try:
+        columns = {}
+        for i, name in enumerate(df.columns):
+            array, meta = _column_array(df[name])
+            meta["file"] = f"{i}.npy"
+            np.save(tmp / meta["file"], np.ascontiguousarray(array))
+            columns[name] = meta
+        metadata = {"version": version, "rows": len(df), "columns": columns}
+        (tmp / METADATA_NAME).write_text(json.dumps(metadata))
+        try:
+            tmp.rename(directory)
+        except OSError:
+            # Written by another process in the meantime
+            if column_store_version(directory) is None:
+                raise
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def column_store_version(directory):
+    """Version of the data in a column store. None if there is no store."""
+    try:
+        metadata = json.loads((Path(directory) / METADATA_NAME).read_text())
+    except FileNotFoundError:
+        return None
+    return metadata["version"]
+
+
+def read_column_store(directory):
+    """Read a column store as a frame of memory-mapped, read-only arrays.
+
+    Args:
+        directory (str or Path): Folder of the store.
+
+    Returns:
+        df (DataFrame): Data of the store, with its version and number of
+            rows in df.attrs.
+    """
+    directory = Path(directory)
+    metadata = json.loads((directory / METADATA_NAME).read_text())
+    columns = {
+        name: pd.Series(
+            _column(np.load(directory / meta["file"], mmap_mode="r"), meta),
+            copy=False,
+        )
+        for name, meta in metadata["columns"].items()
+    }
+    df = pd.DataFrame(columns, copy=False)
+    df.attrs["version"] = metadata["version"]
+    df.attrs["rows"] = metadata["rows"]
+    return df
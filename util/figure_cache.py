@@ -0,0 +1,119 @@
+"""Cache of built figures, shared by all sessions of the server process.
+
+A figure is kept as its serialized JSON, keyed by the version of the dataset
+it shows, the function that built it and its parameters. A rerun with the same
+parameters, eg. after another widget changed, or another session showing the
+same view, loads the JSON instead of querying and building the figure again.
+The cache holds at most max_bytes of JSON and evicts the least recently used
+figures first.
+
+Plotly figures and altair charts are supported.
+"""
+import datetime
+import json
+import threading
+from collections import Counter, OrderedDict
+
+import altair as alt
+import numpy as np
+import pandas as pd
+import plotly.io as pio
+
+# Bytes of figure JSON kept by default
+DEFAULT_MAX_BYTES = 64 * 1024**2
+
+
+def _normalize(value):
+    """Parameter value as plain JSON data, so equal parameters give equal keys."""
+    if isinstance(value, (pd.Timestamp, datetime.datetime, datetime.date)):
+        value = pd.Timestamp(value)
+        if value.tz is None:
+            value = value.tz_localize("UTC")
+        return value.tz_convert("UTC").isoformat()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [_normalize(item) for item in value]
+    if isinstance(value, dict):
+        return {str(key): _normalize(item) for key, item in value.items()}
+    return value
+
+
+def figure_key(version, function, params):
+    """Key of a figure of a dataset version built by function with params."""
+    name = f"{function.__module__}.{function.__qualname__}"
+    return version, name, json.dumps(_normalize(params), sort_keys=True)
+
+
+def _dumps(figure):
+    """Kind and JSON of a figure."""
+    if hasattr(figure, "to_plotly_json"):
+        return "plotly", figure.to_json()
+    # Altair charts, restored with the class of the chart
+    return type(figure).__name__, figure.to_json()
+
+
+def _loads(kind, figure_json):
+    """Figure of a kind and JSON written by _dumps."""
+    if kind == "plotly":
+        return pio.from_json(figure_json)
+    return getattr(alt, kind).from_json(figure_json)
+
+
+class FigureCache:
+    """LRU cache of figure JSON bounded by bytes.
+
+    Args:
+        max_bytes (int): Most bytes of JSON to keep.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        # Kind, JSON and bytes of each key, least recently used first
+        self._figures = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Counts of "hits", "misses" and "evictions"
+        self.stats = Counter()
+
+    def __len__(self):
+        return len(self._figures)
+
+    def figure(self, version, function, inputs=None, **params):
+        """Figure of a dataset version, built by function if it is not cached.
+
+        Args:
+            version (str): Version of the dataset, eg. from dataset_version.
+            function (callable): Builds the figure from inputs and params.
+            inputs (dict): Arguments of function that are not part of the key,
+                eg. the data frame, which is identified by the version.
+            params: Arguments of function that are part of the key.
+
+        Returns:
+            figure (plotly figure or altair chart): A new figure object, so it
+                may be modified by the caller.
+        """
+        key = figure_key(version, function, params)
+        with self._lock:
+            cached = self._figures.get(key)
+            if cached is not None:
+                self._figures.move_to_end(key)
+                self.stats["hits"] += 1
+        if cached is not None:
+            return _loads(*cached[:2])
+
+        # Built outside the lock, so other figures are served meanwhile
+        figure = function(**(inputs or {}), **params)
+        kind, figure_json = _dumps(figure)
+        size = len(figure_json.encode())
+        with self._lock:
+            self.stats["misses"] += 1
+            if size <= self.max_bytes and key not in self._figures:
+                self._figures[key] = (kind, figure_json, size)
+                self.bytes += size
+                while self.bytes > self.max_bytes:
+                    _, (_, _, evicted) = self._figures.popitem(last=False)
+                    self.bytes -= evicted
+                    self.stats["evictions"] += 1
+        return figure
@@ -0,0 +1,92 @@
+"""Checkpoint journal for playlist downloads.
+
+Every enriched page of a playlist is appended to a json lines file as soon as
+it is done. If a download is interrupted, eg. by an expired token, a network
+error or a streamlit rerun, the next download of the same playlist snapshot
+reads the journal and only requests the pages that are missing.
+"""
+import json
+import os
+from pathlib import Path
+
+JOURNAL_DIR = Path("data/playlists/.journal")
+
+
+class PlaylistJournal:
+    """Journal of the completed pages of one playlist download.
+
+    Args:
+        playlist_id (str): ID of the playlist being downloaded.
+        snapshot_id (str): Snapshot of the playlist. A journal written for
+            another snapshot is discarded, since its pages may have shifted.
+        directory (str or Path): Folder to keep journals in.
+    """
+
+    def __init__(self, playlist_id, snapshot_id=None, directory=JOURNAL_DIR):
+        self.playlist_id = playlist_id
+        self.snapshot_id = snapshot_id
+        self.path = Path(directory) / f"{playlist_id}.jsonl"
+        self._file = None
+
+    def completed(self):
+        """Pages finished by earlier, interrupted downloads.
+
+        Returns:
+            pages (dict): Enriched tracks of each completed page offset.
+        """
+        if not self.path.is_file():
+            return {}
+
+        pages = {}
+        with open(self.path) as f:
+            lines = f.read().splitlines()
+        if not lines:
+            return {}
+        try:
+            header = json.loads(lines[0])
+        except json.JSONDecodeError:
+            header = {}
+        if header.get("snapshot_id") != self.snapshot_id:
+            print(f"Discarding journal of another snapshot of {self.playlist_id}")
+            self.remove()
+            return {}
+
+        for n_valid, line in enumerate(lines[1:], start=1):
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line is cut off if the process died while writing it.
+                # Drop it, so new pages are not appended after a broken line.
+                print(f"Dropping incomplete journal entry of {self.playlist_id}")
+                self.path.write_text("\n".join(lines[:n_valid]) + "\n")
+                break
+            pages[entry["offset"]] = entry["tracks"]
+        if pages:
+            print(f"Resuming {self.playlist_id} from {len(pages)} completed pages")
+        return pages
+
+    def record(self, offset, tracks):
+        """Append a completed page to the journal and flush it to disk."""
+        if self._file is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            new = not self.path.is_file() or self.path.stat().st_size == 0
+            self._file = open(self.path, "a")
+            if new:
+                header = {
+                    "playlist_id": self.playlist_id,
+                    "snapshot_id": self.snapshot_id,
+                }
+                self._file.write(json.dumps(header) + "\n")
+        self._file.write(json.dumps({"offset": offset, "tracks": tracks}) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        """Delete the journal, eg. when the download has finished."""
+        self.close()
+        self.path.unlink(missing_ok=True)
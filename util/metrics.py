@@ -0,0 +1,138 @@
+"""Per-endpoint instrumentation of Spotify API calls.
+
+Every call made through util.ratelimit.call is recorded in the module level
+METRICS object: number of calls, errors, retries and 429 answers, a latency
+histogram and the number of bytes received, per endpoint. The summary can be
+printed, or dumped as JSON to track ingestion performance over time.
+"""
+import bisect
+import json
+import threading
+import time
+from collections import defaultdict
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+METRICS_PATH = "data/ingest_metrics.jsonl"
+
+# Bytes received by the current thread, filled in by the session response hook
+_received = threading.local()
+
+
+def _count_bytes(response, *args, **kwargs):
+    _received.bytes = getattr(_received, "bytes", 0) + len(response.content)
+
+
+def _new_endpoint():
+    return {
+        "calls": 0,
+        "errors": 0,
+        "retries": 0,
+        "rate_limited": 0,
+        "bytes": 0,
+        "seconds": 0.0,
+        "max_seconds": 0.0,
+        "latency_histogram": [0] * (len(LATENCY_BUCKETS) + 1),
+    }
+
+
+class ApiMetrics:
+    """Thread safe counters of API calls per endpoint."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.endpoints = defaultdict(_new_endpoint)
+            self.started = time.time()
+
+    @staticmethod
+    def instrument(sp):
+        """Count the bytes received by a spotipy client. Safe to call repeatedly."""
+        session = getattr(sp, "_session", None)
+        hooks = getattr(session, "hooks", None)
+        if hooks is not None and _count_bytes not in hooks["response"]:
+            hooks["response"].append(_count_bytes)
+
+    @staticmethod
+    def start():
+        """Start measuring a request made by the current thread."""
+        _received.bytes = 0
+        return time.perf_counter()
+
+    def record(self, endpoint, start, status=None):
+        """Record a finished request.
+
+        Args:
+            endpoint (str): Name of the endpoint, eg. "playlist_items".
+            start (float): Value returned by start() before the request was sent.
+            status (int): HTTP status of a failed request. None if it succeeded.
+        """
+        seconds = time.perf_counter() - start
+        with self._lock:
+            stats = self.endpoints[endpoint]
+            stats["calls"] += 1
+            stats["bytes"] += getattr(_received, "bytes", 0)
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            stats["latency_histogram"][
+                bisect.bisect_left(LATENCY_BUCKETS, seconds)
+            ] += 1
+            if status is not None:
+                stats["errors"] += 1
+            if status == 429:
+                stats["rate_limited"] += 1
+
+    def record_retry(self, endpoint):
+        with self._lock:
+            self.endpoints[endpoint]["retries"] += 1
+
+    def to_dict(self):
+        with self._lock:
+            endpoints = {
+                endpoint: dict(
+                    stats, latency_histogram=list(stats["latency_histogram"])
+                )
+                for endpoint, stats in sorted(self.endpoints.items())
+            }
+        return {
+            "started": self.started,
+            "seconds": time.time() - self.started,
+            "latency_buckets": LATENCY_BUCKETS,
+            "endpoints": endpoints,
+        }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def save(self, path=METRICS_PATH, **extra):
+        """Append the metrics as one JSON line to a file.
+
+        Args:
+            path (str or Path): File to append to.
+            extra: Additional values to store with the metrics, eg. playlist id.
+        """
+        with open(path, "a") as f:
+            f.write(json.dumps({**extra, **self.to_dict()}) + "\n")
+
+    def summary(self):
+        """Table of the metrics per endpoint."""
+        lines = [
+            f"{'endpoint':<24}{'calls':>7}{'errors':>8}{'retries':>9}{'429s':>6}"
+            f"{'mean ms':>9}{'max ms':>9}{'kB':>9}"
+        ]
+        for endpoint, stats in self.to_dict()["endpoints"].items():
+            mean = stats["seconds"] / stats["calls"] if stats["calls"] else 0.0
+            lines.append(
+                f"{endpoint:<24}{stats['calls']:>7}{stats['errors']:>8}"
+                f"{stats['retries']:>9}{stats['rate_limited']:>6}"
+                f"{mean * 1000:>9.0f}{stats['max_seconds'] * 1000:>9.0f}"
+                f"{stats['bytes'] / 1000:>9.1f}"
+            )
+        return "\n".join(lines)
+
+
+METRICS = ApiMetrics()
@@ -0,0 +1,276 @@
+"""Local stand-in for the parts of the Spotify Web API used by spotify.py.
+
+The server generates a deterministic fake catalogue and serves it over plain
+http on localhost, so the ingestion code can be exercised end to end through
+spotipy without credentials or network access.
+
+Example:
+    Point a spotipy client at the stand-in and count the calls it makes::
+
+        with MockSpotifyAPI(n_tracks=2000) as api:
+            sp = api.client()
+            playlist_df, playlist_name = analyze_playlist(api.playlist_id, sp)
+            print(api.calls)
+"""
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+import spotipy
+
+AUDIO_FEATURES = [
+    "danceability",
+    "energy",
+    "key",
+    "loudness",
+    "mode",
+    "speechiness",
+    "instrumentalness",
+    "liveness",
+    "valence",
+    "tempo",
+    "duration_ms",
+    "time_signature",
+]
+
+
+class MockSpotifyAPI:
+    """Threaded http server that mimics the Spotify Web API.
+
+    Args:
+        n_tracks (int): Number of tracks in the fake playlist.
+        first_track (int): Number of the first track in the playlist. Increase it
+            together with n_tracks to emulate tracks being removed and added.
+        n_artists (int): Number of distinct artists the tracks are spread over.
+        playlist_id (str): ID the fake playlist is served under.
+        playlists (dict): Extra playlists to serve, given as (first_track, n_tracks)
+            for each playlist id. Tracks are shared between overlapping playlists.
+        delay (float): Seconds to sleep before answering each request.
+        rate_limit_every (int): Answer every n'th request with a 429. 0 disables it.
+        retry_after (int): Value of the Retry-After header sent with a 429.
+    """
+
+    def __init__(
+        self,
+        n_tracks=2000,
+        first_track=0,
+        n_artists=300,
+        playlist_id="mockplaylist",
+        playlists=None,
+        delay=0.0,
+        rate_limit_every=0,
+        retry_after=1,
+    ):
+        self.n_tracks = n_tracks
+        self.first_track = first_track
+        self.n_artists = n_artists
+        self.playlist_id = playlist_id
+        self.playlists = playlists or {}
+        self.delay = delay
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+
+        # Number of requests per endpoint, and the number of injected 429s
+        self.calls = Counter()
+        self.rate_limited = 0
+        self._requests = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1/"
+
+    def start(self):
+        """Start serving on a free localhost port in a background thread."""
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                api._handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def client(self, **kwargs):
+        """Spotipy client that talks to the stand-in instead of api.spotify.com.
+
+        A plain session without retries is used, so 429 answers reach the
+        caller together with their Retry-After header.
+        """
+        kwargs.setdefault("requests_session", requests.Session())
+        sp = spotipy.Spotify(auth="mock-token", **kwargs)
+        sp.prefix = self.url
+        return sp
+
+    @property
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self.rate_limited = 0
+            self._requests = 0
+
+    # Fake catalogue
+    def _track_id(self, i):
+        return f"track{i:07d}"
+
+    def _artist_id(self, i):
+        return f"artist{i % self.n_artists:05d}"
+
+    def _track(self, i):
+        artist_id = self._artist_id(i)
+        return {
+            "id": self._track_id(i),
+            "name": f"Track {i}",
+            "popularity": i % 100,
+            "explicit": bool(i % 2),
+            "album": {"name": f"Album {i // 10}"},
+            "artists": [{"id": artist_id, "name": f"Artist {artist_id[6:]}"}],
+        }
+
+    def _audio_features(self, track_id):
+        i = int(track_id[5:])
+        features = {name: (i % 97) / 97 for name in AUDIO_FEATURES}
+        features.update(
+            key=i % 12, mode=i % 2, duration_ms=180000 + i, time_signature=4
+        )
+        features["id"] = track_id
+        return features
+
+    def _artist(self, artist_id):
+        i = int(artist_id[6:])
+        return {
+            "id": artist_id,
+            "name": f"Artist {i}",
+            "genres": [f"genre {i % 25}", f"genre {i % 7}"] if i % 10 else [],
+        }
+
+    # Request handling
+    def _handle(self, request):
+        url = urlparse(request.path)
+        path = url.path[len("/v1/") :].strip("/").split("/")
+        params = {key: value[0] for key, value in parse_qs(url.query).items()}
+
+        if self.delay:
+            time.sleep(self.delay)
+
+        with self._lock:
+            self._requests += 1
+            throttle = (
+                self.rate_limit_every and self._requests % self.rate_limit_every == 0
+            )
+            if throttle:
+                self.rate_limited += 1
+            else:
+                self.calls[self._endpoint(path)] += 1
+
+        if throttle:
+            self._send(
+                request,
+                429,
+                {"error": {"status": 429, "message": "API rate limit exceeded"}},
+                {"Retry-After": str(self.retry_after)},
+            )
+            return
+
+        body = self._route(path, params)
+        if body is None:
+            self._send(request, 404, {"error": {"status": 404, "message": "Not found"}})
+        else:
+            self._send(request, 200, body)
+
+    @staticmethod
+    def _endpoint(path):
+        if path[0] == "playlists":
+            return "playlist_items" if len(path) > 2 else "playlist"
+        if path[0] == "me":
+            return "current_user_top_tracks"
+        if path[0] == "artists":
+            return "artist" if len(path) > 1 else "artists"
+        return path[0].replace("-", "_")
+
+    def _route(self, path, params):
+        ids = params.get("ids", "").split(",") if params.get("ids") else []
+
+        if path[0] == "playlists":
+            if path[1] == self.playlist_id:
+                name = "Mock playlist"
+                first_track, n_tracks = self.first_track, self.n_tracks
+            elif path[1] in self.playlists:
+                name = f"Mock playlist {path[1]}"
+                first_track, n_tracks = self.playlists[path[1]]
+            else:
+                return None
+            if len(path) == 2:
+                return {
+                    "id": path[1],
+                    "name": name,
+                    "snapshot_id": f"snapshot-{first_track}-{n_tracks}",
+                    "tracks": {"total": n_tracks},
+                }
+            offset = int(params.get("offset", 0))
+            limit = int(params.get("limit", 100))
+            items = [
+                {
+                    "added_at": f"2020-01-01T00:{i // 60 % 60:02d}:{i % 60:02d}Z",
+                    "track": self._track(first_track + i),
+                }
+                for i in range(offset, min(offset + limit, n_tracks))
+            ]
+            return {"items": items, "total": n_tracks, "offset": offset}
+
+        if path[0] == "audio-features":
+            return {"audio_features": [self._audio_features(i) for i in ids]}
+
+        if path[0] == "artists":
+            if len(path) > 1:
+                return self._artist(path[1])
+            return {"artists": [self._artist(i) for i in ids]}
+
+        if path[:3] == ["me", "top", "tracks"]:
+            offset = int(params.get("offset", 0))
+            limit = int(params.get("limit", 20))
+            total = min(self.n_tracks, 99)
+            items = [self._track(i) for i in range(offset, min(offset + limit, total))]
+            return {"items": items, "total": total, "offset": offset}
+
+        return None
+
+    @staticmethod
+    def _send(request, status, body, headers=None):
+        payload = json.dumps(body).encode()
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(payload)))
+        for key, value in (headers or {}).items():
+            request.send_header(key, value)
+        request.end_headers()
+        request.wfile.write(payload)
@@ -0,0 +1,421 @@
+"""Queries of the streaming analyses with interchangeable backends.
+
+The plots only ask for the aggregations they show, eg. the most played tracks
+of a range of days, and a backend answers them:
+
+- PandasQueries works on the streaming history in memory and its daily rollup.
+  It needs nothing beyond pandas and is the fallback.
+- DuckDBQueries runs the same aggregations as SQL over the parquet store on
+  disk. Filters on time are pushed down to the year and month partitions and
+  the row group statistics of the files, and the queries run on all cores.
+
+Both backends return the same frames, which check_backends verifies. Tracks
+are counted per title without feature statements in parenthesis, and ties are
+ordered by name.
+"""
+import functools
+import inspect
+import threading
+
+import numpy as np
+import pandas as pd
+
+from util.rollup import DailyRollup
+from util.schema import track_titles
+
+# Columns of the results of each query
+TOP_COLUMNS = ["trackName", "artistName", "size"]
+WEEKDAY_COLUMNS = ["weekday", "trackName", "artistName", "size"]
+YEARLY_COLUMNS = ["endTime", "trackName", "artistName", "ms_played", "count"]
+
+
+def _codes(column):
+    """Integer codes and lookup table of the names in a column.
+
+    Returns:
+        codes (ndarray): Code of each row, -1 if missing.
+        names (Index): Name of each code.
+    """
+    if not isinstance(column.dtype, pd.CategoricalDtype):
+        column = column.astype("category")
+    return column.cat.codes.to_numpy(), column.cat.categories
+
+
+def _name_rank(column):
+    """Position of the name of each row in name order, from its integer code."""
+    codes, names = _codes(column)
+    rank = np.empty(len(names), dtype=np.int64)
+    rank[names.argsort()] = np.arange(len(names))
+    return np.where(codes >= 0, rank[codes], -1)
+
+
+def track_artist_keys(df):
+    """Integer key of the track title and artist of each play.
+
+    The titles are read from the trackTitle column added at load, and derived
+    from the track names if there is none.
+
+    Returns:
+        keys (ndarray): Key of each play, -1 if the track or artist is missing.
+        titles (Index): Track title of each title code.
+        artists (Index): Artist of each artist code.
+    """
+    if "trackTitle" in df.columns:
+        title, titles = _codes(df["trackTitle"])
+    else:
+        title, titles = _codes(pd.Series(track_titles(df["trackName"])))
+    artist, artists = _codes(df["artistName"])
+    keys = title.astype(np.int64) * len(artists) + artist
+    keys[(title < 0) | (artist < 0)] = -1
+    return keys, titles, artists
+
+
+def rollup_keys(rollup):
+    """Keys of the track title and artist of each pair of a rollup.
+
+    Computed once per rollup, not on every query, and kept on the rollup, so
+    they are freed with it.
+    """
+    keys = rollup.__dict__.get("_track_artist_keys")
+    if keys is None:
+        keys = rollup._track_artist_keys = track_artist_keys(rollup.pairs)
+    return keys
+
+
+def grouped_top_plays(groups, n_groups, keys, titles, artists, n, plays=None):
+    """Play counts of the n most played keys of each group.
+
+    The plays of all groups are counted in one aggregation on the combined
+    group and key. The top n of each group are then found with a partial sort
+    of its counts, and only they are sorted and mapped back to track and
+    artist names. Ties are ordered by name.
+
+    Args:
+        groups (ndarray): Group of each key, 0 to n_groups - 1.
+        n_groups (int): Number of groups.
+        keys (ndarray): Key of each play as returned by track_artist_keys.
+        titles (Index): Track title of each title code.
+        artists (Index): Artist of each artist code.
+        n (int): Number of keys per group.
+        plays (ndarray): Number of plays of each key, eg. of a rollup row.
+            One play per key if None.
+
+    Returns:
+        top (DataFrame): group, trackName, artistName and number of plays
+            (size), most played first within each group.
+    """
+    valid = keys >= 0
+    n_keys = len(titles) * len(artists)
+    combined = groups[valid].astype(np.int64) * n_keys + keys[valid]
+    if plays is None:
+        counts = pd.Series(combined).value_counts(sort=False)
+    else:
+        counts = pd.Series(plays[valid]).groupby(combined, sort=False).sum()
+        counts = counts[counts > 0]
+    combined = counts.index.to_numpy()
+    size = counts.to_numpy()
+    group = combined // n_keys
+
+    # Counts of each group, in group order
+    order = np.argsort(group, kind="stable")
+    bounds = np.searchsorted(group[order], np.arange(n_groups + 1))
+    selected = []
+    for i in range(n_groups):
+        rows = order[bounds[i] : bounds[i + 1]]
+        if len(rows) > n:
+            # The n-th largest count, ties of it are kept and ordered by name
+            nth = np.partition(size[rows], len(rows) - n)[len(rows) - n]
+            rows = rows[size[rows] >= nth]
+        selected.append(rows)
+    rows = np.concatenate(selected) if selected else np.array([], dtype=np.int64)
+
+    key = combined[rows] % n_keys
+    top = pd.DataFrame(
+        {
+            "group": group[rows],
+            "trackName": np.asarray(titles, dtype=object)[key // len(artists)],
+            "artistName": np.asarray(artists, dtype=object)[key % len(artists)],
+            "size": size[rows].astype(np.int64),
+        }
+    )
+    top = top.sort_values(
+        ["group", "size", "trackName", "artistName"],
+        ascending=[True, False, True, True],
+    )
+    return top.groupby("group").head(n).reset_index(drop=True)
+
+
+def top_plays(keys, titles, artists, n, plays=None):
+    """Play counts of the n most played keys, see grouped_top_plays.
+
+    Returns:
+        top (DataFrame): trackName, artistName and number of plays (size).
+    """
+    groups = np.zeros(len(keys), dtype=np.int8)
+    top = grouped_top_plays(groups, 1, keys, titles, artists, n, plays)
+    return top.drop(columns="group")
+
+
+def _kept(query):
+    """Keep the results of a query on its backend.
+
+    The backends are created once per dataset version, see
+    streaming_data.get_streaming_queries, so the query runs once per data
+    update. The results are shared and must not be modified.
+    """
+
+    signature = inspect.signature(query)
+
+    @functools.wraps(query)
+    def kept_query(self, *args, **kwargs):
+        results = self.__dict__.setdefault("_results", {})
+        # Positional and keyword arguments of the same value share a key,
+        # the arguments after self in the order of the signature
+        arguments = signature.bind(self, *args, **kwargs)
+        arguments.apply_defaults()
+        key = (query.__name__, *list(arguments.arguments.items())[1:])
+        if key not in results:
+            results[key] = query(self, *args, **kwargs)
+        return results[key]
+
+    return kept_query
+
+
+class PandasQueries:
+    """Queries of a streaming history in memory.
+
+    Args:
+        df (DataFrame): Streaming history sorted by endTime.
+        rollup (DailyRollup): Daily rollup of df. Computed from df when it
+            is first needed if None.
+    """
+
+    name = "pandas"
+
+    def __init__(self, df, rollup=None):
+        self.df = df
+        self._rollup = rollup
+
+    @property
+    def rollup(self):
+        """Daily rollup of the history, computed on first use if not given."""
+        if self._rollup is None:
+            self._rollup = DailyRollup.from_plays(self.df)
+        return self._rollup
+
+    def top_tracks(self, n, start=None, end=None):
+        """Most played tracks in a range of days.
+
+        Args:
+            n (int): Number of tracks.
+            start (datetime): First day of the range. Unbounded if None.
+            end (datetime): Last day of the range, included. Unbounded if None.
+
+        Returns:
+            top (DataFrame): trackName, artistName and plays (size), most
+                played first.
+        """
+        # Plays per track in the range from the prefix sums of the rollup
+        totals = self.rollup.totals(start, end)
+        keys, titles, artists = rollup_keys(self.rollup)
+        return top_plays(keys, titles, artists, n, totals["plays"].to_numpy())
+
+    def weekday_top_tracks(self, n, start=None, end=None, months=None):
+        """Most played tracks of each weekday in a range of days.
+
+        Args:
+            n (int): Number of tracks per weekday.
+            start (datetime): First day of the range. Unbounded if None.
+            end (datetime): Last day of the range, included. Unbounded if None.
+            months (tuple of int): Only count plays in these months. All if None.
+
+        Returns:
+            top (DataFrame): weekday (0 is monday), trackName, artistName and
+                plays (size), most played first within each weekday.
+        """
+        # Days of the rollup in the range, a slice of its day sorted rows. The
+        # index of the rows is their position in the rollup.
+        positions = self.rollup.between(start, end).index.to_numpy()
+        if months:
+            in_months = np.zeros(13, dtype=bool)
+            in_months[list(months)] = True
+            positions = positions[in_months[self.rollup.month[positions]]]
+
+        # The top tracks of all weekdays from one aggregation
+        pair_keys, titles, artists = rollup_keys(self.rollup)
+        top = grouped_top_plays(
+            self.rollup.weekday[positions],
+            7,
+            pair_keys[self.rollup.pair[positions]],
+            titles,
+            artists,
+            n,
+            self.rollup.rows["plays"].to_numpy()[positions],
+        )
+        return top.rename(columns={"group": "weekday"})[WEEKDAY_COLUMNS]
+
+    @_kept
+    def yearly_top_tracks(self, n):
+        """Most played tracks of each year.
+
+        Args:
+            n (int): Number of tracks per year.
+
+        Returns:
+            top (DataFrame): Year (endTime), trackName, artistName, ms_played
+                and plays (count), most played first within each year. Kept
+                on the backend, so it is computed once.
+        """
+        df = self.df
+        # Group on the integer codes of the categorical names
+        df = (
+            df.groupby(
+                [df["endTime"].dt.year, "trackName", "artistName"], observed=True
+            )
+            .agg(ms_played=("ms_played", "sum"), count=("ms_played", "size"))
+            .reset_index()
+            .astype({"ms_played": "int64"})
+        )
+        # One sort by year, count and name, then the first n of each year
+        order = np.lexsort(
+            (
+                _name_rank(df["artistName"]),
+                _name_rank(df["trackName"]),
+                -df["count"].to_numpy(),
+                df["endTime"].to_numpy(),
+            )
+        )
+        df = df.iloc[order]
+        first_n = df.groupby("endTime").cumcount().to_numpy() < n
+        return df[first_n].reset_index(drop=True)[YEARLY_COLUMNS]
+
+
+class DuckDBQueries:
+    """Queries of the parquet store of the streaming history with DuckDB.
+
+    Args:
+        path (str or Path): Folder of the store with year=/month= partitions.
+        threads (int): Number of threads of a query. All cores if None.
+    """
+
+    name = "duckdb"
+
+    def __init__(self, path, threads=None):
+        import duckdb
+
+        self.path = path
+        self._connection = duckdb.connect()
+        # Days and weekdays in UTC, like the rollup
+        self._connection.execute("SET TimeZone = 'UTC'")
+        if threads is not None:
+            self._connection.execute(f"SET threads = {int(threads)}")
+        self._local = threading.local()
+
+    def _cursor(self):
+        """Connection of the calling thread, connections can not be shared."""
+        if not hasattr(self._local, "cursor"):
+            self._local.cursor = self._connection.cursor()
+        return self._local.cursor
+
+    def _plays(self, start=None, end=None, months=None):
+        """FROM and WHERE clauses and parameters of the plays in a range of days."""
+        # The files are a parameter, so the path needs no quoting
+        source = (
+            "read_parquet(?, hive_partitioning = true, "
+            "hive_types = {'year': INTEGER, 'month': INTEGER})"
+        )
+        where = ["trackName IS NOT NULL", "artistName IS NOT NULL"]
+        parameters = [f"{self.path}/year=*/month=*/*.parquet"]
+        # Filter on the partition columns as well, so only the partitions of
+        # the range are opened
+        if start is not None:
+            start = DailyRollup.day_start(start)
+            where += ["year >= ?", "endTime >= ?"]
+            parameters += [start.year, start]
+        if end is not None:
+            end = DailyRollup.day_start(end) + pd.Timedelta(days=1)
+            where += ["year <= ?", "endTime < ?"]
+            parameters += [end.year, end]
+        if months:
+            where.append(f"month IN ({', '.join(str(int(m)) for m in months)})")
+        return f"FROM {source} WHERE {' AND '.join(where)}", parameters
+
+    def _top(self, select, n, plays, parameters, partition=None):
+        """Top n rows per partition of counts of plays grouped by the columns
+        of select, ordered by count and then by name."""
+        sql = f"""
+            SELECT * FROM (SELECT {select}, count(*) AS size {plays} GROUP BY ALL)
+            QUALIFY row_number() OVER (
+                {f"PARTITION BY {partition}" if partition else ""}
+                ORDER BY size DESC, trackName, artistName
+            ) <= {int(n)}
+            ORDER BY {f"{partition}, " if partition else ""}
+                size DESC, trackName, artistName
+        """
+        return self._cursor().execute(sql, parameters).df()
+
+    def top_tracks(self, n, start=None, end=None):
+        """Most played tracks in a range of days, see PandasQueries.top_tracks."""
+        plays, parameters = self._plays(start, end)
+        select = "split_part(trackName, '(', 1) AS trackName, artistName"
+        return self._top(select, n, plays, parameters)[TOP_COLUMNS]
+
+    def weekday_top_tracks(self, n, start=None, end=None, months=None):
+        """Most played tracks of each weekday, see PandasQueries.weekday_top_tracks."""
+        plays, parameters = self._plays(start, end, months)
+        select = (
+            "isodow(endTime) - 1 AS weekday, "
+            "split_part(trackName, '(', 1) AS trackName, artistName"
+        )
+        top = self._top(select, n, plays, parameters, partition="weekday")
+        return top[WEEKDAY_COLUMNS]
+
+    @_kept
+    def yearly_top_tracks(self, n):
+        """Most played tracks of each year, see PandasQueries.yearly_top_tracks."""
+        plays, parameters = self._plays()
+        select = (
+            "year(endTime) AS endTime, trackName, artistName, "
+            "sum(ms_played)::BIGINT AS ms_played"
+        )
+        top = self._top(select, n, plays, parameters, partition="endTime")
+        return top.rename(columns={"size": "count"})[YEARLY_COLUMNS]
+
+
+def _same(a, b):
+    """Whether two query results have the same rows, values compared as text."""
+    if len(a) != len(b) or list(a.columns) != list(b.columns):
+        return False
+    return (
+        a.astype(str)
+        .reset_index(drop=True)
+        .equals(b.astype(str).reset_index(drop=True))
+    )
+
+
+def check_backends(a, b, time_ranges=((None, None),), n=10):
+    """Run every query on two backends and compare the results.
+
+    Args:
+        a, b (PandasQueries or DuckDBQueries): Backends of the same data.
+        time_ranges (list of tuple): First and last day of the ranges to query.
+        n (int): Number of tracks of the top n queries.
+
+    Returns:
+        equal (dict): Whether the backends agree, per query.
+    """
+    equal = {
+        "top_tracks": True,
+        "weekday_top_tracks": True,
+        "yearly_top_tracks": _same(a.yearly_top_tracks(n), b.yearly_top_tracks(n)),
+    }
+    for start, end in time_ranges:
+        equal["top_tracks"] &= _same(
+            a.top_tracks(n, start, end), b.top_tracks(n, start, end)
+        )
+        for months in (None, (12, 1, 2)):
+            equal["weekday_top_tracks"] &= _same(
+                a.weekday_top_tracks(n, start, end, months),
+                b.weekday_top_tracks(n, start, end, months),
+            )
+    return equal
@@ -0,0 +1,104 @@
+"""Client side rate limiting of Spotify API calls.
+
+All threads making API calls share one TokenBucket. A call takes a token
+before it is sent, and a 429 answer pauses the whole bucket for the time given
+in the Retry-After header, so concurrent workers back off together instead of
+each hammering the API on their own.
+"""
+import threading
+import time
+
+import spotipy
+
+from util.metrics import METRICS
+
+# Status codes that are worth retrying
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """Token bucket scheduler shared between threads.
+
+    Args:
+        rate (float): Tokens added per second, ie. the sustained request rate.
+        capacity (int): Maximum number of tokens, ie. the size of a burst.
+    """
+
+    def __init__(self, rate=10.0, capacity=10):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+        # Number of tokens handed out, ie. requests sent through the bucket
+        self.requests = 0
+
+    def acquire(self):
+        """Block until a token is available and take it."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if now >= self._blocked_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    self.requests += 1
+                    return
+                wait = max(self._blocked_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Stop handing out tokens for the given number of seconds."""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+
+
+def _retry_after(exception, attempt):
+    """Seconds to wait before retrying a failed call."""
+    headers = getattr(exception, "headers", None) or {}
+    try:
+        return float(headers["Retry-After"])
+    except (KeyError, TypeError, ValueError):
+        return min(2**attempt, 30)
+
+
+def call(func, *args, bucket=None, max_retries=5, **kwargs):
+    """Call a spotipy method through the rate limiter.
+
+    Every attempt is recorded per endpoint in util.metrics.METRICS.
+
+    Args:
+        func (callable): Bound spotipy method to call, eg. sp.playlist_items.
+        bucket (TokenBucket): Shared scheduler. If None the call is not rate limited.
+        max_retries (int): Number of times to retry on 429 or server errors.
+
+    Returns:
+        The result of func.
+    """
+    endpoint = func.__name__
+    METRICS.instrument(getattr(func, "__self__", None))
+    for attempt in range(max_retries + 1):
+        if bucket is not None:
+            bucket.acquire()
+        start = METRICS.start()
+        try:
+            result = func(*args, **kwargs)
+        except spotipy.SpotifyException as exception:
+            METRICS.record(endpoint, start, exception.http_status)
+            if exception.http_status not in RETRY_STATUS or attempt == max_retries:
+                raise
+            wait = _retry_after(exception, attempt)
+            print(f"Got status {exception.http_status}, retrying in {wait} s")
+            METRICS.record_retry(endpoint)
+            if bucket is not None and exception.http_status == 429:
+                bucket.pause(wait)
+            else:
+                time.sleep(wait)
+        else:
+            METRICS.record(endpoint, start)
+            return result
@@ -0,0 +1,153 @@
+"""Local read-through cache of files in a remote bucket.
+
+A remote file is downloaded once per version of the object, ie. its generation
+or ETag, and kept on local disk as parquet. Later reads only ask the bucket
+for the metadata of the object, which is cheap, and read the local copy while
+the version is unchanged. The cache folder can be shared by all processes on a
+host, since files are only ever written to a temporary name and renamed into
+place.
+
+Any fsspec filesystem works, eg. gcsfs for the bucket and the local or memory
+filesystem for testing.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+import pandas as pd
+
+REMOTE_CACHE_DIR = Path("data/.remote_cache")
+
+# Seconds a checked version is trusted before the bucket is asked again
+DEFAULT_REVALIDATE_AFTER = 60
+
+# Metadata fields that identify the version of an object, in order of preference
+VERSION_FIELDS = ["generation", "etag", "ETag", "md5Hash"]
+
+
+def _object_version(info):
+    """Version of a remote object from the result of fs.info."""
+    for field in VERSION_FIELDS:
+        if info.get(field):
+            return str(info[field]).strip('"')
+    # Filesystems without object versions, eg. the local filesystem
+    return f"{info.get('size')}-{info.get('mtime', info.get('created'))}"
+
+
+def _digest(value):
+    return hashlib.sha1(str(value).encode()).hexdigest()[:16]
+
+
+class RemoteFileCache:
+    """Read-through cache of remote parquet and csv files.
+
+    Args:
+        fs (fsspec.AbstractFileSystem): Filesystem of the remote files.
+        directory (str or Path): Local folder of the cached files.
+        revalidate_after (float): Seconds before the version of a remote file is
+            checked again. Within this time the last checked version is used.
+    """
+
+    def __init__(
+        self,
+        fs,
+        directory=REMOTE_CACHE_DIR,
+        revalidate_after=DEFAULT_REVALIDATE_AFTER,
+    ):
+        self.fs = fs
+        self.directory = Path(directory)
+        self.revalidate_after = revalidate_after
+
+        # Time and version of the last check of each remote file
+        self._checked = {}
+        self._lock = threading.Lock()
+
+        # Counts of "disk" and "download" reads and "revalidations"
+        self.stats = Counter()
+
+    def _local_path(self, path, version):
+        return self.directory / f"{_digest(path)}-{_digest(version)}.parquet"
+
+    def version(self, path):
+        """Current version of a remote file, checked at most every revalidate_after s."""
+        checked = self._checked.get(path)
+        if (
+            checked is not None
+            and time.monotonic() - checked[0] < self.revalidate_after
+        ):
+            return checked[1]
+
+        # Skip the listings cached by the filesystem, they may be stale
+        self.fs.invalidate_cache(path)
+        version = _object_version(self.fs.info(path))
+        self._checked[path] = (time.monotonic(), version)
+        self.stats["revalidations"] += 1
+        return version
+
+    def _download(self, path, version):
+        """Download a remote file to the cache as parquet.
+
+        Returns:
+            local (Path): Cached file. None if the object changed while downloading.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        local = self._local_path(path, version)
+        tmp = local.with_name(f".{local.name}.{os.getpid()}.{threading.get_ident()}")
+        try:
+            if str(path).endswith(".parquet"):
+                self.fs.get_file(path, str(tmp))
+            else:
+                with self.fs.open(path, "rt") as f:
+                    pd.read_csv(f, parse_dates=["endTime"]).to_parquet(tmp, index=False)
+
+            # The object may have been replaced after its version was checked
+            self.fs.invalidate_cache(path)
+            if _object_version(self.fs.info(path)) != version:
+                return None
+            os.replace(tmp, local)
+        finally:
+            tmp.unlink(missing_ok=True)
+
+        # Remove copies of older versions
+        for old in self.directory.glob(f"{_digest(path)}-*.parquet"):
+            if old != local:
+                old.unlink(missing_ok=True)
+        return local
+
+    def _local_file(self, path):
+        """Local copy of the current version of a remote file, downloaded if needed.
+
+        Must be called with the lock held.
+
+        Returns:
+            local (Path): Cached file.
+            version (str): Version of the remote file.
+        """
+        while True:
+            version = self.version(path)
+            local = self._local_path(path, version)
+            if local.is_file():
+                self.stats["disk"] += 1
+                return local, version
+            self.stats["download"] += 1
+            local = self._download(path, version)
+            if local is not None:
+                return local, version
+            # Changed during the download, start over with the new version
+            self._checked.pop(path, None)
+
+    def local_file(self, path):
+        """Local parquet copy of the current version of a remote file.
+
+        Args:
+            path (str): Path of the file in the remote filesystem.
+
+        Returns:
+            local (Path): Cached file.
+            version (str): Version of the remote file.
+        """
+        with self._lock:
+            return self._local_file(path)
@@ -0,0 +1,165 @@
+"""Daily play counts of the streaming history.
+
+The rollup has one row per day, track and artist with the number of plays and
+the time played. It is much smaller than the play log, and prefix sums over
+the days of each track make the total plays of every track in any date range
+two binary searches per track, without touching the individual days.
+"""
+import numpy as np
+import pandas as pd
+
+from util.schema import track_titles
+from util.timeindex import TimeIndex
+
+# Columns of the rollup. endTime is the start of the day in UTC.
+ROLLUP_COLUMNS = ["endTime", "trackName", "artistName", "plays", "ms_played"]
+
+_NS_PER_DAY = 24 * 3600 * 10**9
+
+
+def _day(time):
+    """Days since the epoch of a timestamp, taken as UTC if it has no time zone."""
+    time = pd.Timestamp(time)
+    if time.tz is None:
+        time = time.tz_localize("UTC")
+    return time.value // _NS_PER_DAY
+
+
+def aggregate_plays(df):
+    """Aggregate plays to rollup rows.
+
+    Args:
+        df (DataFrame): Plays with endTime, trackName, artistName and ms_played.
+
+    Returns:
+        rows (DataFrame): Plays and ms_played per day, track and artist.
+    """
+    return (
+        df.groupby(
+            [df["endTime"].dt.floor("D"), "trackName", "artistName"],
+            observed=True,
+            sort=False,
+        )
+        .agg(plays=("ms_played", "size"), ms_played=("ms_played", "sum"))
+        .reset_index()
+        .astype({"plays": "int32", "ms_played": "int64"})
+    )
+
+
+class DailyRollup:
+    """Plays per day, track and artist with prefix sums over the days.
+
+    Args:
+        rows (DataFrame): Rollup rows as returned by aggregate_plays. Rows of
+            the same day, track and artist are added up, so rollups of several
+            parts of the history can be concatenated.
+    """
+
+    def __init__(self, rows):
+        rows = rows.astype({"trackName": "category", "artistName": "category"})
+        rows = (
+            rows.groupby(["trackName", "artistName", "endTime"], observed=True)
+            .agg(plays=("plays", "sum"), ms_played=("ms_played", "sum"))
+            .reset_index()[ROLLUP_COLUMNS]
+            .astype({"plays": "int32"})
+        )
+
+        # The grouped rows are sorted by track, artist and day. Number the pairs
+        # of track and artist, and order the rows by pair and day, to binary
+        # search a range of days of every pair at once.
+        names = rows[["trackName", "artistName"]]
+        new_pair = names.ne(names.shift()).any(axis=1).to_numpy()
+        pair = np.cumsum(new_pair) - 1
+        # Track, artist and track title of each pair
+        self.pairs = names.iloc[np.flatnonzero(new_pair)].reset_index(drop=True)
+        self.pairs["trackTitle"] = track_titles(self.pairs["trackName"])
+
+        day = rows["endTime"].astype("int64").to_numpy() // _NS_PER_DAY
+        self._first_day = int(day.min()) if len(day) else 0
+        # One more than the number of days, so a range can end after the last day
+        self._day_span = int(day.max()) - self._first_day + 2 if len(day) else 1
+        self._ordered = pair * self._day_span + (day - self._first_day)
+
+        # Prefix sums in pair and day order, so the sum over a range of days of a
+        # pair is a difference
+        self._cum_plays = np.concatenate([[0], np.cumsum(rows["plays"])])
+        self._cum_ms = np.concatenate([[0], np.cumsum(rows["ms_played"])])
+
+        # The rows themselves are kept sorted by day, so a range of days is a
+        # slice. The pair of each row is kept for grouping.
+        by_day = np.argsort(day, kind="stable")
+        self.rows = rows.iloc[by_day].reset_index(drop=True)
+        self.pair = pair[by_day]
+        self.index = TimeIndex(self.rows["endTime"])
+
+        # Weekday (0 is monday) and month of each row, looked up per day. The
+        # epoch was a thursday.
+        day = day[by_day]
+        self.weekday = ((day + 3) % 7).astype(np.int8)
+        days = pd.date_range(
+            pd.Timestamp(self._first_day * _NS_PER_DAY, tz="UTC"),
+            periods=self._day_span,
+            freq="D",
+        )
+        self.month = days.month.to_numpy(np.int8)[day - self._first_day]
+
+        # Shared by all sessions, so writes raise
+        arrays = (self._ordered, self._cum_plays, self._cum_ms)
+        for array in arrays + (self.pair, self.weekday, self.month):
+            array.flags.writeable = False
+
+    @staticmethod
+    def day_start(time):
+        """Start of the day of a timestamp in UTC, the endTime of its rollup rows."""
+        return pd.Timestamp(_day(time) * _NS_PER_DAY, tz="UTC")
+
+    @classmethod
+    def from_plays(cls, df):
+        """Rollup of a play log with endTime, trackName, artistName and ms_played."""
+        return cls(aggregate_plays(df))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _offset(self, day):
+        """Offset of a day in the rollup, clipped to the days of the rollup."""
+        return min(max(day - self._first_day, 0), self._day_span - 1)
+
+    def between(self, start=None, end=None):
+        """Rows of the days in a range, as a view of the rows.
+
+        Args:
+            start (datetime): First day of the range. Unbounded if None.
+            end (datetime): Last day of the range, included. Unbounded if None.
+
+        Returns:
+            rows (DataFrame): Rollup rows. The index is the position in rows.
+        """
+        return self.index.slice(
+            self.rows,
+            None if start is None else self.day_start(start),
+            None if end is None else self.day_start(end),
+            include_start=True,
+        )
+
+    def totals(self, start=None, end=None):
+        """Plays and ms_played of each track and artist in a range of days.
+
+        Args:
+            start (datetime): First day of the range. Unbounded if None.
+            end (datetime): Last day of the range, included. Unbounded if None.
+
+        Returns:
+            totals (DataFrame): trackName, artistName, plays and ms_played with one
+                row per track and artist, also those without plays in the range.
+        """
+        low = 0 if start is None else self._offset(_day(start))
+        high = self._day_span - 1 if end is None else self._offset(_day(end) + 1)
+        high = max(high, low)
+        first = np.arange(len(self.pairs)) * self._day_span
+        lower = np.searchsorted(self._ordered, first + low)
+        upper = np.searchsorted(self._ordered, first + high)
+        return self.pairs.assign(
+            plays=self._cum_plays[upper] - self._cum_plays[lower],
+            ms_played=self._cum_ms[upper] - self._cum_ms[lower],
+        )
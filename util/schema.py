@@ -0,0 +1,170 @@
+"""Column types of the datasets used by the dashboard.
+
+Every loader converts its data to these types with apply_schema, so all frames
+use the same compact types: 32 bit numbers, categoricals for repeated strings
+and UTC timestamps. Data that does not fit its schema raises a SchemaError
+when it is loaded, instead of failing later in a plot.
+"""
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+# Plays of the streaming history
+STREAMING_SCHEMA = {
+    "endTime": "datetime64[ns, UTC]",
+    "ms_played": "int32",
+    "trackName": "category",
+    "artistName": "category",
+    "reason_start": "category",
+    "reason_end": "category",
+    "shuffle": "bool",
+    "skipped": "float32",
+}
+# Not in the account data export or the small sample dataset
+STREAMING_OPTIONAL = ["reason_start", "reason_end", "shuffle", "skipped"]
+
+# Tracks of a downloaded playlist, see spotify.PLAYLIST_COLUMNS
+PLAYLIST_SCHEMA = {
+    "artist": "category",
+    "genre": "category",
+    "album": "category",
+    "track_name": "object",
+    "track_id": "object",
+    "danceability": "float32",
+    "energy": "float32",
+    "key": "category",
+    "loudness": "float32",
+    "mode": "int32",
+    "speechiness": "float32",
+    "instrumentalness": "float32",
+    "liveness": "float32",
+    "valence": "float32",
+    "tempo": "float32",
+    "duration_ms": "int32",
+    "time_signature": "int32",
+    "track_popularity": "float32",
+    "added_at": "datetime64[ns, UTC]",
+    "artist_id": "object",
+}
+# Not stored by older versions of spotify.py
+PLAYLIST_OPTIONAL = ["track_popularity", "added_at", "artist_id"]
+
+# User top tracks, see spotify.TOP_TRACKS_COLUMNS
+TOP_TRACKS_SCHEMA = {
+    "artist": "category",
+    "track_name": "object",
+    "popularity": "int32",
+    "explicit": "bool",
+}
+
+# Arrow types of the schema types, used when writing parquet
+_ARROW_TYPES = {
+    "datetime64[ns, UTC]": pa.timestamp("ns", tz="UTC"),
+    "int32": pa.int32(),
+    "float32": pa.float32(),
+    "bool": pa.bool_(),
+    "category": pa.dictionary(pa.int32(), pa.string()),
+    "object": pa.string(),
+}
+
+
+class SchemaError(ValueError):
+    """Data that does not fit its schema."""
+
+
+def arrow_schema(schema):
+    """Arrow schema of a schema, eg. for writing parquet files."""
+    return pa.schema(
+        [(column, _ARROW_TYPES[dtype]) for column, dtype in schema.items()]
+    )
+
+
+def _convert(column, dtype):
+    if dtype.startswith("datetime64"):
+        return pd.to_datetime(column, utc=True).astype(dtype)
+    converted = column.astype(dtype)
+    if dtype.startswith("int") and not (converted == column).all():
+        raise ValueError(f"values out of the range of {dtype}")
+    return converted
+
+
+def apply_schema(df, schema, optional=(), name="data"):
+    """Convert a frame to the types of a schema.
+
+    Columns not in the schema are dropped. The frame is returned as is if it
+    already has the schema.
+
+    Args:
+        df (DataFrame): Data to convert.
+        schema (dict): Type of each column.
+        optional (list of str): Columns of the schema that may be missing.
+        name (str): Name of the data used in error messages.
+
+    Returns:
+        df (DataFrame): Data with the types of the schema.
+
+    Raises:
+        SchemaError: If a required column is missing or can not be converted.
+    """
+    missing = [c for c in schema if c not in df.columns and c not in optional]
+    if missing:
+        raise SchemaError(f"{name} is missing the columns {missing}")
+
+    columns = [column for column in schema if column in df.columns]
+    converted = {}
+    for column in columns:
+        dtype = schema[column]
+        if df[column].dtype == dtype:
+            continue
+        try:
+            converted[column] = _convert(df[column], dtype)
+        except (TypeError, ValueError) as exception:
+            raise SchemaError(
+                f"Column {column} of {name} can not be converted to {dtype}: {exception}"
+            ) from exception
+
+    if not converted and list(df.columns) == columns:
+        return df
+    return df[columns].assign(**converted)
+
+
+def track_titles(track_name):
+    """Track names without feature statements in parenthesis, eg. for grouping
+    plays of the same song.
+
+    Only the distinct names are shortened, not the name of every play.
+
+    Args:
+        track_name (Series): Categorical track names.
+
+    Returns:
+        titles (Categorical): Title of each name, missing if the name is.
+    """
+    if not isinstance(track_name.dtype, pd.CategoricalDtype):
+        track_name = track_name.astype("category")
+    names = track_name.cat.categories
+    title_of_name, titles = pd.factorize(names.str.split("(").str[0])
+    codes = track_name.cat.codes.to_numpy()
+    return pd.Categorical.from_codes(
+        np.where(codes >= 0, title_of_name[codes], -1), titles, validate=False
+    )
+
+
+def read_csv(path, schema, optional=(), **kwargs):
+    """Read a csv file with the types of a schema.
+
+    Only the columns of the schema are read.
+
+    Args:
+        path (str or Path or file): File to read.
+        schema (dict): Type of each column.
+        optional (list of str): Columns of the schema that may be missing.
+        kwargs: Passed on to pd.read_csv.
+
+    Returns:
+        df (DataFrame): Data with the types of the schema.
+    """
+    # Timestamps are parsed by apply_schema
+    dtypes = {c: t for c, t in schema.items() if not t.startswith("datetime64")}
+    df = pd.read_csv(path, usecols=lambda c: c in schema, dtype=dtypes, **kwargs)
+    return apply_schema(df, schema, optional, name=str(path))
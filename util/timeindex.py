@@ -0,0 +1,66 @@
+"""Binary search over the play times of a time sorted frame.
+
+The loaders sort the streaming history by endTime. A TimeIndex keeps the play
+times as an int64 array of ns since the epoch, which is a view of the column
+and not a copy, and finds the rows of a time range with a binary search. The
+rows are then selected with a slice, which is a view of the frame, instead of
+a boolean mask over every row that copies the selected rows.
+"""
+import numpy as np
+import pandas as pd
+
+
+def _epoch(time):
+    """ns since the epoch of a timestamp, taken as UTC if it has no time zone."""
+    time = pd.Timestamp(time)
+    if time.tz is None:
+        time = time.tz_localize("UTC")
+    return time.value
+
+
+class TimeIndex:
+    """Sorted play times of a frame.
+
+    Args:
+        end_time (Series): Timestamps sorted in increasing order, eg. the
+            endTime column of the streaming history.
+
+    Raises:
+        ValueError: If end_time is not sorted.
+    """
+
+    def __init__(self, end_time):
+        self.epoch = end_time.array.asi8
+        if np.any(self.epoch[1:] < self.epoch[:-1]):
+            raise ValueError("The times of a TimeIndex must be sorted")
+
+    def __len__(self):
+        return len(self.epoch)
+
+    def bounds(self, start=None, end=None, include_start=False):
+        """Positions of the first and after the last row in a time range.
+
+        Args:
+            start (datetime): Start of the range. Unbounded if None.
+            end (datetime): End of the range, included. Unbounded if None.
+            include_start (bool): Whether rows at exactly start are included.
+
+        Returns:
+            low, high (int): The rows in the range are low:high.
+        """
+        low = 0
+        if start is not None:
+            side = "left" if include_start else "right"
+            low = int(np.searchsorted(self.epoch, _epoch(start), side=side))
+        high = len(self)
+        if end is not None:
+            high = int(np.searchsorted(self.epoch, _epoch(end), side="right"))
+        return low, max(low, high)
+
+    def slice(self, df, start=None, end=None, include_start=False):
+        """Rows of df in a time range, as a view of df.
+
+        df must be the frame the index was built from. See bounds for the args.
+        """
+        low, high = self.bounds(start, end, include_start)
+        return df.iloc[low:high]
@@ -4,9 +4,10 @@ import urllib
 import pandas as pd
 import spotipy
 import streamlit as st
-from spotipy import SpotifyOAuth
 
 from spotify import spotify_driver
+from util.client import get_spotify_client
+from util.schema import PLAYLIST_OPTIONAL, PLAYLIST_SCHEMA, TOP_TRACKS_SCHEMA, read_csv
 
 
 @st.cache_data
@@ -16,43 +17,14 @@ def load_metadata(url):
 
 @st.cache_data
 def get_playlist_df(data):
-    # Define the dtypes for columns to ensure correct format for later analysis
-    dtypes = {
-        "artist": "str",
-        "genre": "str",
-        "album": "str",
-        "track_name": "str",
-        "track_id": "str",
-        "danceability": "float",
-        "energy": "float",
-        "key": "str",
-        "loudness": "float",
-        "speechiness": "float",
-        "instrumentalness": "float",
-        "liveness": "float",
-        "valence": "float",
-        "tempo": "float",
-        "duration_ms": "int",
-        "time_signature": "int",
-        "track_popularity": "float",
-        "added_at": "str",
-    }
-    parse_dates = ["time_signature"]
-    df = pd.read_csv(data, dtype=dtypes, parse_dates=parse_dates)
-
+    # Read with the compact types of the playlist schema
+    df = read_csv(data, PLAYLIST_SCHEMA, PLAYLIST_OPTIONAL)
     return df.set_index("track_name")
 
 
 @st.cache_data
 def get_top_tracks_df(data):
-    # Define the dtypes for columns to ensure correct format for later analysis
-    dtypes = {
-        "artist": "str",
-        "track_name": "str",
-        "popularity": "int",
-        "explicit": "bool",
-    }
-    df = pd.read_csv(data, dtype=dtypes)
+    df = read_csv(data, TOP_TRACKS_SCHEMA)
     return df.set_index("track_name")
 
 
@@ -74,14 +46,7 @@ def aquire_data_app():
     placeholder = st.empty()
     playlist_id = placeholder.text_input("Please enter a valid playlist id")
     try:
-        sp = spotipy.Spotify(
-            auth_manager=SpotifyOAuth(
-                client_id=st.secrets["CLIENT_ID"],
-                client_secret=st.secrets["CLIENT_SECRET"],
-                redirect_uri=st.secrets["REDIRECT_URI"],
-                scope=scope,
-            )
-        )
+        sp = get_spotify_client(scope)
         playlist_name = sp.playlist(playlist_id)["name"]
     except spotipy.SpotifyException as exception:
         st.error("Please enter a valid playlist id")